@@ -23,6 +23,10 @@ SIGMA = 0.01
 
 LZ_ADJUST = 50
 
+# On-disk cache of window complexities (None to disable)
+CACHE_FILE = "complexity_cache.sqlite"
+CACHE_ENTRIES = 1 << 22
+
 def calculate_lz(signal):
     # Linear Detrending
     signal = detrend(signal)
@@ -72,47 +76,71 @@ def read_csv_columns(file_path, column_names):
 
 
 def combined_process_eeg_data(file_path):
-    # Load EEG data
-    eeg_data = pd.read_csv(file_path)
-
     # Prepare for sliding window analysis
     window_length_samples = WINDOW_SIZE * SAMPLE_RATE
     step_length_samples = STEP_SIZE * SAMPLE_RATE
 
-    # Prepare DataFrames for saving complexities
-    lz_complexity_df = pd.DataFrame()
-    sc_complexity_df = pd.DataFrame()
-
-    # Process each column
-    for column in tqdm(COLUMNS, desc="Processing EEG Columns"):
-        lz_complexity_values = []
-        sc_complexity_values = []
-        time_stamps = []
-
-        for start in range(0, len(eeg_data) - window_length_samples + 1, step_length_samples):
-            end = start + window_length_samples
-            window_signal = eeg_data[column].iloc[start:end]
-                        
-            if window_signal.isna().any():
+    # Complexities of each column, one value per window
+    lz_complexity_values = {column: [] for column in COLUMNS}
+    sc_complexity_values = {column: [] for column in COLUMNS}
+    time_stamps = []
+
+    # Complexities already computed for a window are taken from the cache
+    cache = ResultCache(CACHE_FILE, CACHE_ENTRIES) if CACHE_FILE else None
+
+    # Stream the EEG data, holding about one window of every column at a time
+    windows = stream_windows(file_path, COLUMNS, window_length_samples, step_length_samples)
+    for start, window in tqdm(windows, desc="Processing EEG Windows"):
+        # Columns with NaNs have no complexities, the others are looked up in the cache together
+        signals = {column: window[:, i] for i, column in enumerate(COLUMNS) if not np.isnan(window[:, i]).any()}
+        keys, found = {}, {}
+        if cache is not None:
+            for column, window_signal in signals.items():
+                keys[column] = (cache.key(window_signal, "lz"),
+                                cache.key(window_signal, "sc", LAMBDA, SIGMA, "overlapping", "median"))
+            lookup = [key for column_keys in keys.values() for key in column_keys]
+            found = dict(zip(lookup, cache.get_many(lookup)))
+        new_keys, new_values = [], []
+
+        for column in COLUMNS:
+            if column not in signals:
             # Add NaN to complexity lists and continue
-                lz_complexity_values.append(np.nan)
-                sc_complexity_values.append(np.nan)
-                time_stamps.append(start / SAMPLE_RATE)
+                lz_complexity_values[column].append(np.nan)
+                sc_complexity_values[column].append(np.nan)
                 continue
+            window_signal = signals[column]
+            lz_key, sc_key = keys.get(column, (None, None))
 
             # Lempel-Ziv Complexity
-            lz_complexity = calculate_lz(window_signal.values)
-            lz_complexity_values.append(lz_complexity)
+            lz_complexity = found.get(lz_key)
+            if lz_complexity is None:
+                with stage_timer("lz"):
+                    lz_complexity = calculate_lz(window_signal)
+                new_keys.append(lz_key)
+                new_values.append(lz_complexity)
+            lz_complexity_values[column].append(lz_complexity)
 
             # Statistical Complexity
-            binary_string = binarise(window_signal.values)
-            sc_complexity = calculate(binary_string, LAMBDA, SIGMA)
-            sc_complexity_values.append(sc_complexity)
+            sc_complexity = found.get(sc_key)
+            if sc_complexity is None:
+                binary_string = binarise(window_signal)
+                sc_complexity = calculate(binary_string, LAMBDA, SIGMA)
+                new_keys.append(sc_key)
+                new_values.append(sc_complexity)
+            sc_complexity_values[column].append(sc_complexity)
+
+        # Every complexity calculated for the window is stored at once
+        if cache is not None and new_keys:
+            cache.put_many(new_keys, new_values)
 
-            time_stamps.append(start / SAMPLE_RATE)
+        time_stamps.append(start / SAMPLE_RATE)
 
-        lz_complexity_df[column] = lz_complexity_values
-        sc_complexity_df[column] = sc_complexity_values
+    if cache is not None:
+        cache.close()
+
+    # Prepare DataFrames for saving complexities
+    lz_complexity_df = pd.DataFrame(lz_complexity_values, columns=COLUMNS)
+    sc_complexity_df = pd.DataFrame(sc_complexity_values, columns=COLUMNS)
 
     # Plotting LZ Complexity
     plt.figure(figsize=(12, 6))
@@ -153,15 +181,24 @@ def combined_process_eeg_data(file_path):
     for column in COLUMNS:
         combined_complexity_df[column + '_SC'] = sc_complexity_df[column].rolling(rolling_steps, min_periods=1).mean().tolist()
 
-    combined_complexity_df.round(3).to_csv(file_path.replace('.csv', '_combined_complexity.csv'), index=False)
+    with stage_timer("write_csv"):
+        combined_complexity_df.round(3).to_csv(file_path.replace('.csv', '_combined_complexity.csv'), index=False)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Process EEG data from a CSV file.")
     parser.add_argument("file_path", help="Path to the CSV file")
+    parser.add_argument("--instrument", metavar="REPORT",
+                        help="Save the time spent in each stage and the counts of every state collapse to a JSON file")
     args = parser.parse_args()
 
-    combined_process_eeg_data(args.file_path)
+    if args.instrument:
+        start_instrumentation()
+    try:
+        combined_process_eeg_data(args.file_path)
+    finally:
+        if args.instrument:
+            stop_instrumentation(args.instrument)
 
 if __name__ == "__main__":
     main()
@@ -21,10 +21,14 @@ lambda_high = 12
 sigma_low = 0.01
 sigma_high = 0.02
 
-def calculate_sc(signal, lambda_, sigma_):
-    # Statistical Complexity Calculation
+# On-disk cache of window complexities (None to disable)
+CACHE_FILE = "complexity_cache.sqlite"
+CACHE_ENTRIES = 1 << 22
+
+def calculate_sc(signal, lambdas, sigmas):
+    # Statistical Complexity Calculation for every lambda and sigma, finding the states of the binarised window once
     binary_string = binarise(signal)
-    return calculate(binary_string, lambda_, sigma_)
+    return calculate_lambdas(binary_string, lambdas, sigmas)
 
 def sliding_window_process(data, window_size, overlap, sample_rate):
     # Apply a sliding window on the data.
@@ -38,9 +42,13 @@ def sliding_window_process(data, window_size, overlap, sample_rate):
     return windowed_data
 
 def read_csv_column(file_path, column_name):
-    # Read a single column from a CSV file.
+    # Read a single column from a CSV file, or from its binary store when that is up to date.
+    voltages = open_voltages(file_path, [column_name])
+    if voltages is not None:
+        return pd.DataFrame({column_name: voltages[column_name]})
     try:
-        data = pd.read_csv(file_path, usecols=[column_name])
+        with stage_timer("read_csv"):
+            data = pd.read_csv(file_path, usecols=[column_name])
         return data
     except Exception as e:
         print(f"Error reading CSV file: {e}")
@@ -58,28 +66,43 @@ def process_eeg_data(file_path):
 
     # DataFrame to store complexity values for each lambda and sigma
     complexity_df = pd.DataFrame()
-
-    # Iterate over lambda and sigma values
-    for lambda_ in tqdm(range(lambda_low, lambda_high), desc="Lambda values"):  # lambda from 2 to 7    
-        for sigma_ in np.arange(sigma_low, sigma_high, 0.01):  # sigma from 0.01 to 0.1
-            sc_complexity_values = []
-            time_stamps = []
-
-            for start in range(0, len(eeg_data) - window_length_samples + 1, step_length_samples):
-                end = start + window_length_samples
-                window_signal = eeg_data[COLUMN].iloc[start:end]
-                        
-                if window_signal.isna().any():
-                    sc_complexity_values.append(np.nan)
-                    continue
-
-                # Statistical Complexity
-                sc_complexity = calculate_sc(window_signal.values, lambda_, sigma_)
-                sc_complexity_values.append(sc_complexity)
-
-            # Accumulate data for plotting and CSV
-            complexity_df[f'Lambda_{lambda_}_Sigma_{sigma_}'] = sc_complexity_values
-            plt.plot(range(len(sc_complexity_values)), sc_complexity_values, label=f'Lambda={lambda_}, Sigma={sigma_}')
+    lambdas = list(range(lambda_low, lambda_high))  # lambda from 2 to 7
+    sigmas = np.arange(sigma_low, sigma_high, 0.01)  # sigma from 0.01 to 0.1
+    sc_complexity_values = {(lambda_, sigma_): [] for lambda_ in lambdas for sigma_ in sigmas}
+
+    # Complexities already computed for a window are taken from the cache
+    cache = ResultCache(CACHE_FILE, CACHE_ENTRIES) if CACHE_FILE else None
+
+    # Each window is binarised once and swept over every lambda and sigma
+    for start in tqdm(range(0, len(eeg_data) - window_length_samples + 1, step_length_samples), desc="Windows"):
+        end = start + window_length_samples
+        window_signal = eeg_data[COLUMN].iloc[start:end]
+
+        if window_signal.isna().any():
+            sweep = np.full((len(lambdas), len(sigmas)), np.nan)
+        elif cache is None:
+            # Statistical Complexity
+            sweep = calculate_sc(window_signal.values, lambdas, sigmas)
+        else:
+            keys = [[cache.key(window_signal.values, "sc", lambda_, sigma_, "overlapping", "median") for sigma_ in sigmas]
+                    for lambda_ in lambdas]
+            sweep = np.array(cache.get_many(sum(keys, [])), dtype=float).reshape(len(lambdas), len(sigmas))
+            # Only the lambdas missing a sigma are swept again
+            missing = [i for i in range(len(lambdas)) if np.isnan(sweep[i]).any()]
+            if missing:
+                sweep[missing] = calculate_sc(window_signal.values, [lambdas[i] for i in missing], sigmas)
+                cache.put_many(sum([keys[i] for i in missing], []), sweep[missing].ravel())
+        for i, lambda_ in enumerate(lambdas):
+            for j, sigma_ in enumerate(sigmas):
+                sc_complexity_values[(lambda_, sigma_)].append(sweep[i, j])
+
+    if cache is not None:
+        cache.close()
+
+    # Accumulate data for plotting and CSV
+    for (lambda_, sigma_), values in sc_complexity_values.items():
+        complexity_df[f'Lambda_{lambda_}_Sigma_{sigma_}'] = values
+        plt.plot(range(len(values)), values, label=f'Lambda={lambda_}, Sigma={sigma_}')
 
     # Plotting SC Complexity for all combinations of lambda and sigma
     plt.xlabel('Time (seconds)')
@@ -91,15 +114,24 @@ def process_eeg_data(file_path):
 
     # Save to CSV
     output_filename = file_path.replace('.csv', '_combos.csv')
-    complexity_df.to_csv(output_filename, index=False)
+    with stage_timer("write_csv"):
+        complexity_df.to_csv(output_filename, index=False)
     print(f"Saved complexity data to {output_filename}")
 
 def main():
     parser = argparse.ArgumentParser(description="Process EEG data for statistical complexity.")
     parser.add_argument("file_path", help="Path to the EEG CSV file")
+    parser.add_argument("--instrument", metavar="REPORT",
+                        help="Save the time spent in each stage and the counts of every state collapse to a JSON file")
     args = parser.parse_args()
 
-    process_eeg_data(args.file_path)
+    if args.instrument:
+        start_instrumentation()
+    try:
+        process_eeg_data(args.file_path)
+    finally:
+        if args.instrument:
+            stop_instrumentation(args.instrument)
 
 if __name__ == "__main__":
     main()
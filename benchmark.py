@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import complexity_e_all
+from main import *
+
+# Global variables
+SAMPLE_RATE = 500  # Hz, as the raw-voltage CSVs
+LAMBDAS = [2, 4, 7, 10, 12]
+SIGMAS = [0.01, 0.05, 0.1]
+WINDOW_SIZES = [5, 10, 30, 60]  # seconds
+ENGINES = ["dict", "numpy", "suffix"]
+STATE_ENGINES = ["dict", "numpy"]  # Engines with their own find_states and collapse_states ("suffix" only calculates)
+DICT_MAX_LAMBDA = 8  # The dict engine is only timed up to this lambda (it takes minutes per call beyond)
+CHECK_LAMBDAS = list(range(1, DICT_MAX_LAMBDA + 1))
+CHECK_SIGMAS = [0.01, 0.05, 0.1, 0.25, 0.5, 0.7]  # 0.7 checks the fallback above sigma = 0.5
+CHECK_STRINGS = 50  # Random strings compared for each lambda and sigma
+PIPELINE_SECONDS = 60  # Length of the recording run through the full pipeline
+
+
+def synthetic_eeg(seconds, channels=1, seed=0):
+    """
+    Create EEG-like signals: 1/f-like background from an AR(1) process, a 10 Hz alpha rhythm and white noise.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SAMPLE_RATE)
+    noise = rng.standard_normal((channels, n))
+    background = np.zeros((channels, n))
+    for i in range(1, n):
+        background[:, i] = 0.98 * background[:, i - 1] + noise[:, i]
+    t = np.arange(n) / SAMPLE_RATE
+    phase = rng.uniform(0, 2 * np.pi, (channels, 1))
+    alpha = 2 * np.sin(2 * np.pi * 10 * t + phase) * (1 + 0.5 * np.sin(2 * np.pi * 0.1 * t))
+    return background + alpha + 0.5 * rng.standard_normal((channels, n))
+
+
+def measure(function, repeats):
+    """
+    Time a function over a number of repeats, returning the fastest and median times in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def record(results, stage, repeats, function, **params):
+    best, median = measure(function, repeats)
+    results.append({"stage": stage, **params, "repeats": repeats, "seconds_min": best, "seconds_median": median})
+    print(f"{stage:<10} {json.dumps(params)} {best * 1000:.2f} ms", file=sys.stderr)
+
+
+def benchmark_stages(signal, window, lambdas, sigmas, engines, repeats, results):
+    """
+    Time each stage of the calculation on one window of signal.
+    """
+    record(results, "binarise", repeats, lambda: binarise(signal), window_s=window)
+    string = binarise(signal)
+    for engine in engines:
+        for dl in lambdas:
+            if engine == "dict" and dl > DICT_MAX_LAMBDA:
+                continue
+            if engine not in STATE_ENGINES:
+                for sigma in sigmas:
+                    record(results, "calculate", repeats, lambda: calculate(string, dl, sigma, engine=engine),
+                           window_s=window, engine=engine, method="overlapping", sigma=sigma, **{"lambda": dl})
+                continue
+            for method in ["overlapping", "nonoverlapping"]:
+                record(results, "find_states", repeats,
+                       lambda: find_states(string, dl, method=method, engine=engine),
+                       window_s=window, engine=engine, method=method, **{"lambda": dl})
+            states = find_states(string, dl, method="overlapping", engine=engine)
+            for sigma in sigmas:
+                params = dict(window_s=window, engine=engine, method="overlapping", sigma=sigma, **{"lambda": dl})
+                record(results, "collapse_states", repeats,
+                       lambda: collapse_states(states, dl, sigma, engine=engine), **params)
+                record(results, "calculate", repeats,
+                       lambda: calculate(string, dl, sigma, engine=engine), **params)
+                record(results, "calculate_bd", repeats,
+                       lambda: calculate_bd(string, dl, sigma, engine=engine), **params)
+
+
+def benchmark_pipeline(dataframe, source, window, lambdas, sigmas, engines, repeats, results):
+    """
+    Time calculate_and_graph_complexities over a recording, with consecutive windows and no result cache.
+    """
+    complexity_e_all.CACHE_FILE = None
+    complexity_e_all.WINDOW_SIZE = window
+    complexity_e_all.STEP_SIZE = 0  # the overlap between windows
+    complexity_e_all.SAMPLE_RATE = SAMPLE_RATE
+    output_file = os.path.join(tempfile.mkdtemp(), "complexity.csv")
+    for engine in engines:
+        complexity_e_all.ENGINE = engine
+        for dl in lambdas:
+            if engine == "dict" and dl > DICT_MAX_LAMBDA:
+                continue
+            for sigma in sigmas:
+                complexity_e_all.DL, complexity_e_all.SIGMA = dl, sigma
+
+                def run():
+                    complexity_e_all.calculate_and_graph_complexities(dataframe, output_file)
+                    plt.close("all")
+
+                record(results, "pipeline", repeats, run, source=source, seconds=len(dataframe) / SAMPLE_RATE,
+                       window_s=window, engine=engine, sigma=sigma, **{"lambda": dl})
+
+
+def check_engines(engine, lambdas, sigmas, strings, seed=0):
+    """
+    Compare calculate's outputs with the given engine against the dict engine, on random strings of varying length
+    and bias and on binarised synthetic EEG, returning the cases whose complexities are not identical.
+    """
+    rng = np.random.default_rng(seed)
+    signal = synthetic_eeg(strings, seed=seed)[0]
+    mismatches = []
+    for dl in lambdas:
+        for sigma in sigmas:
+            for i in range(strings):
+                if i % 2:
+                    string = binarise(signal[i * SAMPLE_RATE // 2:(i + 1) * SAMPLE_RATE])
+                else:
+                    length = int(rng.integers(1, 5000))
+                    string = "".join(np.where(rng.random(length) < rng.uniform(0.1, 0.9), "1", "0"))
+                for method in ["overlapping", "nonoverlapping"]:
+                    expected = calculate(string, dl, sigma, method=method, engine="dict")
+                    got = calculate(string, dl, sigma, method=method, engine=engine)
+                    if got != expected:
+                        mismatches.append({"lambda": dl, "sigma": sigma, "method": method, "string": string,
+                                           "dict": expected, engine: got})
+    print(f"{engine} vs dict: {len(lambdas) * len(sigmas) * strings * 2} cases, {len(mismatches)} mismatches",
+          file=sys.stderr)
+    return mismatches
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the Statistical Complexity pipeline, "
+                                                 "saving the results as JSON.")
+    parser.add_argument("--output", default="benchmark.json", help="Path of the JSON results")
+    parser.add_argument("--lambdas", type=int, nargs="+", default=LAMBDAS)
+    parser.add_argument("--sigmas", type=float, nargs="+", default=SIGMAS)
+    parser.add_argument("--windows", type=float, nargs="+", default=WINDOW_SIZES, help="Window lengths in seconds")
+    parser.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES)
+    parser.add_argument("--repeats", type=int, default=3, help="Times each measurement is repeated")
+    parser.add_argument("--csv", nargs="*", default=[],
+                        help="Raw-voltage CSV files to also run through the pipeline (first PIPELINE_SECONDS seconds)")
+    parser.add_argument("--skip-pipeline", action="store_true", help="Only time the individual stages")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check that the suffix engine's complexities are identical to the dict engine's, "
+                             f"over lambdas {CHECK_LAMBDAS[0]}-{CHECK_LAMBDAS[-1]} and sigmas {CHECK_SIGMAS}")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check_engines("suffix", CHECK_LAMBDAS, CHECK_SIGMAS, CHECK_STRINGS)
+        for mismatch in mismatches[:10]:
+            print(json.dumps(mismatch), file=sys.stderr)
+        sys.exit(1 if mismatches else 0)
+
+    results = []
+    signal = synthetic_eeg(max(args.windows))[0]
+    for window in args.windows:
+        benchmark_stages(signal[:int(window * SAMPLE_RATE)], window, args.lambdas, args.sigmas, args.engines,
+                         args.repeats, results)
+
+    if not args.skip_pipeline:
+        columns = complexity_e_all.COLUMNS_TO_PROCESS
+        recordings = [("synthetic", pd.DataFrame(synthetic_eeg(PIPELINE_SECONDS, len(columns), seed=1).T,
+                                                 columns=columns))]
+        for csv_file in args.csv:
+            recordings.append((os.path.basename(csv_file),
+                               pd.read_csv(csv_file, usecols=columns, nrows=PIPELINE_SECONDS * SAMPLE_RATE)))
+        for source, dataframe in recordings:
+            for window in args.windows:
+                if window <= len(dataframe) / SAMPLE_RATE and float(window).is_integer():
+                    benchmark_pipeline(dataframe, source, int(window), args.lambdas, args.sigmas, args.engines,
+                                       args.repeats, results)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "sample_rate": SAMPLE_RATE,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Saved {len(results)} measurements to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,10 @@ import matplotlib.pyplot as plt
 from copy import deepcopy
 import sys
 import csv
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
 
 OUTPUT_FOLDER = "Complexity"
 
@@ -19,384 +23,360 @@ SIGMA = 0.01  # Sigma value for state collapsing
 WINDOW_SIZE = 10  # Window size in seconds
 STEP_SIZE = 1  # Step size in seconds
 SAMPLE_RATE = 500  # Sample rate in Hz
+# State counting engine: "dict" walks the string, "numpy" integer codes, "suffix" suffix groups,
+# "warm" integer codes seeding each window's collapse with the previous window's states (approximate, never cached)
+ENGINE = "numpy"
+THRESHOLD = "window"  # Binarisation threshold: "window" (median of each window), "session" or "block"
+BLOCK_SIZE = 60  # Block length in seconds for a per-block threshold
+STREAM_BATCH = 16  # Windows held at once when streaming a file with per-window thresholds
+CACHE_FILE = "complexity_cache.sqlite"  # On-disk cache of window complexities (None to disable)
+CACHE_ENTRIES = 1 << 22  # Most window complexities kept in the cache
+MEMO_BYTES = 1 << 28  # Memory for the merges of repeated transition tables, reused within a run (0 to disable)
 
-import numpy as np
-from copy import deepcopy
+from main import *
 
-def calculate(istring: str, dl: int, sigma: float = 0.05, method: str = "overlapping",
-                                     states_provided: bool = False, return_states: bool = False):
-    """
-    Find the (forwards) Statistical Complexity of an input string for given lambda and sigma values
-    """
-    #if states are not provided, find them, otherwise declare it
-    if(type(states_provided)==bool):
-        #first, find all states from the input string and the probabilities of presents
-        initial_states = find_states(istring,dl,method=method)
-        #next, collapse states which have similar probability distributions
-        refined_states = collapse_states(initial_states,dl,sigma)
-    else:
-        #collapse the states based purely on keynames (already done)
-        initial_states,refined_states = states_provided,states_provided
-    #convert this into a list of probabilities
-    probs = collapse_past(refined_states)
-    #create an array of logbase2 probabilities for use in the calculation
-    logprobs = np.log2(probs)
-    #sum the negative of probability * log2 probability of each state to get the statistical complexity
-    complexity = 0.0
-    for i in range(len(probs)):
-        complexity -= probs[i]*logprobs[i]
-    #if states are not desired, only return complexity
-    if(return_states==False):
-        return complexity
-    else:
-        return complexity,refined_states,initial_states
 
-def calculate_multi(istrings,dl: int, sigma: float = 0.05):
+def sliding_window_process(data, window_size, overlap, sample_rate):
     """
-    Find the (forwards) Statistical Complexity values for an array of strings
+    Apply a sliding window on the data.
     """
-    output = []
-    for string in istrings:
-        output.append(calculate(string,dl,sigma))
-    return output
+    windowed_data = []
+    step_size = window_size - overlap
+    num_samples = window_size * sample_rate
 
-def calculate_bd(istring: str, dl: int, sigma: float = 0.05, method: str ="overlapping",
-                              record_states: bool = False):
-    """
-    Find the forwards, reverse and bidirectional statistical complexity for a string
-    """
-    #find statistical complexity of forward string and the refined states
-    f_sc,f_states,f_states_raw = calculate(istring,dl,sigma,return_states=True,method=method)
-    #find complexity of backwards string
-    b_sc,b_states,b_states_raw = calculate(istring[::-1],dl,sigma,return_states=True,method=method)
-    #collapse the states of forward and reverse complexity based purely on key names
-    bd_s = collapse_keys(f_states,b_states)
-    #find complexity of bi-directional machine
-    bd_sc,bd_states,bd_states_raw = calculate("",dl,sigma,states_provided = bd_s,return_states = True)
-    if(record_states==False):
-        return f_sc,b_sc,bd_sc
-    else:
-        return f_sc,b_sc,bd_sc,len(f_states),len(b_states),len(bd_states),len(f_states_raw),len(b_states_raw),len(bd_states_raw)
+    for start in range(0, len(data) - num_samples + 1, step_size * sample_rate):
+        windowed_data.append(data[start:start + num_samples])
+
+    return windowed_data
 
-#Find multiple statistical complexities for forwards, reverse and bidirectional
-def calculate_bd_multi(istrings,dl: int, sigma: float = 0.05):
-    """
-    Find the forwards, reverse and bidirectional Statistical Complexity values for an array of strings
-    """
-    output = []
-    for string in istrings:
-        output.append(calculate_bd(string,dl,sigma))
-    return output
 
-#input string, desired lambda
-def find_states(istring: str, dl: int, method: str = "nonoverlapping"):
+def read_csv_columns(file_path, column_names):
     """
-    Find the states present in a given input string, outputting the past states, their frequency, and their present state distributions
+    Read specified columns from a CSV file.
     """
-    #variables used
-    i,output_dict = 0,{}
-    ## main loop of identifying past and present states
-    # Option 1: Non Overlapping
-    if(method=="nonoverlapping"):
-        while(i+(dl*2)<len(istring)):
-            past,present = istring[i:i+dl],istring[i+dl:i+(2*dl)]
-            if(past not in output_dict):
-                output_dict.update({past: {present:1,"total":1}})
-            else:
-                if(present not in output_dict[past]):
-                    output_dict[past].update({present:1})
-                else:
-                    output_dict[past][present]+=1
-                output_dict[past]["total"]+=1
-            i+=dl
-    #Option 2: Overlapping
-    else:
-        while(i+dl+1<len(istring)):
-            past,present = istring[i:i+dl],istring[i+1:i+1+dl]
-            if(past not in output_dict):
-                output_dict.update({past: {present:1,"total":1}})
-            else:
-                if(present not in output_dict[past]):
-                    output_dict[past].update({present:1})
-                else:
-                    output_dict[past][present]+=1
-                output_dict[past]["total"]+=1
-            i+=1
-    # The last state discovery (main loop misses the final state that can be found)
     try:
-        if(method=="nonoverlapping"):
-            past,present = istring[i:i+dl],istring[i+dl:i+(2*dl)]
-        else:
-            past,present = istring[i:i+dl],istring[i+1:i+1+dl]
-        if(past not in output_dict):
-            output_dict.update({past: {present:1,"total":1}})
-        else:
-            if(present not in output_dict[past]):
-                output_dict[past].update({present:1})
-            else:
-                output_dict[past][present]+=1
-            output_dict[past]["total"]+=1
-    except:
-        pass
-    #collapse counts into probabilities with total counts
-    for past in output_dict:
-        for present in output_dict[past]:
-            if(present!="total"):
-                output_dict[past][present]/=output_dict[past]["total"]
-    return output_dict
-
-def collapse_states(odict: dict, dl: int, sigma: float = 0.1):
-    """
-    Collapse a dictionary of state counts into practical states based on a permitted difference sigma
-    """
-    # Newdict is the collapsed dictionary, temp is used to override newdict when necessary,
-    # done_checker is a dictionary used to record the keys already compared
-    newdict,temp,done_checker = deepcopy(odict),False,{}
-    while(True):
-        # If temp is not a boolean, i.e. it's become a dictionary, override newdict
-        if(type(temp)!=bool):
-            newdict = deepcopy(temp)
-            temp = False
-        for past1 in newdict:
-            if(past1 not in done_checker):
-                done_checker[past1] = {}
-            for past2 in newdict:
-                if(past1!=past2):
-                    if(past2 not in done_checker[past1]):
-                        done_checker[past1][past2] = True
-                    else:
-                        # If these states have already been checked, don't bother checking them again
-                        continue
-                    # If the difference is less than sigma, merge these states and break the past2 loop
-                    if(calculate_difference(newdict[past1],newdict[past2])<sigma):
-                        temp = merge_states(newdict,past1,past2,dl)
-                        break
-            # If the dictionary must be updated, break the past1 loop
-            if(type(temp)!=bool):
-                break
-        # If temp is still a boolean, i.e. there was no merging of states in this loop, break the main loop
-        if(type(temp)==bool):
-            break
-    return newdict
-
-def calculate_difference(past1: dict, past2: dict):
-    """
-    Calculate the difference between two past states' present state distributions
-    """
-    difference = -np.inf
-    # Cycle through past 1 and check for max differences
-    for present in past1:
-        # Ensure this check isn't being performed on the total state count
-        if(present!="total"):
-            if(present not in past2):
-                difference = max(difference,past1[present])
-            else:
-                difference = max(difference,abs(past1[present]-past2[present]))
-    # Cycle through past 2
-    for present in past2:
-        if(present!="total"):
-            if(present not in past1):
-                difference = max(difference,past2[present])
-    return difference
-
-def merge_states(odict: dict, past1: dict, past2: dict, dl: int):
+        with stage_timer("read_csv"):
+            data = pd.read_csv(file_path, usecols=column_names)
+        return data
+    except Exception as e:
+        print(f"Error reading CSV file: {e}")
+        sys.exit(1)
+
+
+def binarise_session(data):
     """
-    Merge 2 states and their present state distributions, creating a new state key in a standardised manner
+    Binarise a whole channel into a packed BitSequence with one threshold for the session,
+    or one per block of BLOCK_SIZE seconds.
     """
-    nprobs = {}
-    for present in odict[past1]:
-        if(present in odict[past2]):
-            nprobs.update({present:(odict[past1][present]+odict[past2][present])/2})
-        else:
-            nprobs.update({present:odict[past1][present]/2})
-    for present in odict[past2]:
-        if(present not in odict[past1]):
-            nprobs.update({present:odict[past2][present]/2})
-    nprobs.update({"total":odict[past1]["total"]+odict[past2]["total"]})
-    #create a sorted version of the two pasts combined
-    temp,to_sort = past1+past2,[]
-    for i in range(int(len(temp)/dl)):
-        to_sort.append(temp[(i*dl):(i*dl)+dl])
-    newkey = ""
-    while(len(to_sort)>0):
-        newkey += to_sort.pop(to_sort.index(min(to_sort)))
-    #add the new key and remove the old ones
-    ndict = deepcopy(odict)
-    ndict.update({newkey:nprobs})
-    del ndict[past1]
-    del ndict[past2]
-    return ndict
-
-#collapse dictionary of past states and future states into an array of probabilities of the past states
-def collapse_past(odict):
+    if THRESHOLD == "session":
+        return binarise_bits(data, packed=True)
+    block = BLOCK_SIZE * SAMPLE_RATE
+    blocks = [binarise_bits(data[start:start + block]) for start in range(0, len(data), block)]
+    return BitSequence(np.concatenate(blocks) if blocks else [])
+
+
+def channel_windows(voltages):
     """
-    Collapse a dictionary of past states with present state distribtuions into an array of probabilities of the past states
+    View the windows of one channel (or of each row of a channels x samples matrix) without copying,
+    the same windows as sliding_window_process.
     """
-    probs,i,total = np.zeros(len(odict),dtype=float),0,0
-    for past in odict:
-        probs[i] += odict[past]["total"]
-        total += odict[past]["total"]
-        i+=1
-    return probs/total
-
-def collapse_keys(d1: dict, d2: dict):
+    num_samples = WINDOW_SIZE * SAMPLE_RATE
+    if voltages.shape[-1] < num_samples:
+        return np.zeros(voltages.shape[:-1] + (0, num_samples))
+    windows = np.lib.stride_tricks.sliding_window_view(voltages, num_samples, axis=-1)
+    return windows[..., ::(WINDOW_SIZE - STEP_SIZE) * SAMPLE_RATE, :]
+
+
+result_cache = None
+
+
+def open_result_cache():
     """
-    Merge 2 dictionaries of past states with present state distributions
-    Note: keys present in both dictionaries lose their probability distributions and only the "total" key remains,
-          but this is all that is needed by the point they are merged
+    Open the result cache (once per process), or return None if it is disabled.
     """
-    ndict = {}
-    for key in d1:
-        # as longer keys are created and sorted in a standard way, they are all standardised
-        temp = False
-        if(key in d2):
-            #if the key is in d2, add the two together and mark this has been done
-            ndict.update({key:{"total":d1[key]["total"]+d2[key]["total"]}})
-            temp = True
-        #if no variant of the key was found in d2, add the key as-is
-        if(temp==False):
-            ndict.update({key:d1[key]})
-    for key in d2:
-        if(key not in ndict):
-            ndict.update({key:d2[key]})
-    return ndict
-
-def probs_to_complexity(probs):
+    global result_cache
+    if CACHE_FILE and result_cache is None:
+        result_cache = ResultCache(CACHE_FILE, CACHE_ENTRIES)
+    return result_cache
+
+
+def window_complexities(windows, seeds=None):
     """
-    Calculate the Statistical Complexity given an array of past state probabilities
+    Calculate the complexity of each of a windows x samples array of one channel's windows,
+    taking every complexity already in the cache from there (per-window thresholds only).
+    With the warm engine, seeds (a dictionary) carries the channel's states on from the windows before.
     """
-    #create an array of logbase2 probabilities for use in the calculation
-    logprobs = np.log2(probs)
-    # Correct any 0-probabilities to become 0 rather than infinity
-    for i in range(len(logprobs)):
-        if(probs[i]==0): logprobs[i] = 0.
-    #sum the negative of probability * log2 probability of each state to get the statistical complexity
-    complexity = 0.0
-    for i in range(len(probs)):
-        complexity -= probs[i]*logprobs[i]
-    return complexity
+    if ENGINE == "warm":
+        # Warm-started results depend on every window before, so the windows are one chain and are never cached
+        return [float(complexity) for complexity in calculate_batch(windows, DL, SIGMA, warm=True, seeds=seeds)]
 
+    cache = open_result_cache()
+    if cache is not None:
+        keys = [cache.key(window, "sc", DL, SIGMA, "overlapping", "median") for window in windows]
+        complexities = cache.get_many(keys)
+    else:
+        complexities = [None] * len(windows)
+    missing = [i for i, complexity in enumerate(complexities) if complexity is None]
+
+    # Missing windows are gathered a batch at a time, never copying all of them at once
+    for start in range(0, len(missing), 256):
+        batch = missing[start:start + 256]
+        if ENGINE == "numpy":
+            computed = calculate_batch(windows[batch], DL, SIGMA)
+        else:
+            computed = [calculate(binarise(windows[i]), DL, SIGMA, engine=ENGINE) for i in batch]
+        for i, complexity in zip(batch, computed):
+            complexities[i] = float(complexity)
+        if cache is not None:
+            cache.put_many([keys[i] for i in batch], [complexities[i] for i in batch])
 
+    return complexities
 
-def binarise(data,mode="median"):
-    """
-    Binarise an array of continuous numbers into an array of 0's and 1's (as a string)
-    """
-    if(type(data)==list or type(data)==tuple):
-        data=np.array(data,dtype=float)
-    if(isinstance(data,np.ndarray)==False):
-        return "Unusable datatype {}".format(type(data))
-    if(mode=="median"):
-        threshold=np.median(data)
-    elif(mode=="mean"):
-        threshold=np.mean(data)
-    output = np.zeros([len(data)],dtype=int)
-    for i in range(len(data)):
-        if(data[i]>=threshold):
-            output[i]+=1
-    # Convert to string
-    outstr = ""
-    for element in output:
-        outstr += str(element)
-    return outstr
-
-def multi_binarise(matrix,mode="median"):
+
+def column_complexities(data):
     """
-    Binarise a 2D matrix (used for calculating multiple statistical complexities)    
+    Calculate the complexity of each window of one channel.
     """
-    print("Binarising data...")
-    # Convert to numpy matrix
-    if(type(matrix)==list or type(matrix)==tuple):
-        matrix=np.array(matrix,dtype=object)
-    output = []
-    percent_check = 0.
-    for i in range(len(matrix)):
-        output.append(binarise(matrix[i],mode))
-        # Output progress
-        if((i+1)/float(len(matrix))>=percent_check/100.):
-            print("{}% of data binarised".format(\
-                round(((i+1)/len(matrix))*100,1)))
-            percent_check+=10.
-    print("Data Binarised")
-    return np.array(output, dtype = object)
-    
+    if THRESHOLD == "window":
+        return window_complexities(channel_windows(np.asarray(data)))
 
+    # With a fixed threshold the windows are slices of one binarised channel, so the transition
+    # counts slide along with them (same windows as sliding_window_process)
+    bits = binarise_session(data)
+    return list(calculate_sliding(bits, DL, SIGMA, WINDOW_SIZE * SAMPLE_RATE,
+                                  (WINDOW_SIZE - STEP_SIZE) * SAMPLE_RATE, warm=(ENGINE == "warm")))
 
 
-def sliding_window_process(data, window_size, overlap, sample_rate):
+def calculate_and_graph_complexities(dataframe, output_file):
     """
-    Apply a sliding window on the data.
+    Calculate complexities for each column (of a DataFrame or of a dictionary of arrays, such as the
+    memory-mapped channels of a binary store), graph the results, and save to a CSV.
     """
-    windowed_data = []
-    step_size = window_size - overlap
-    num_samples = window_size * sample_rate
+    # Channels are taken one at a time, so memory-mapped channels are never all read in at once
+    complexities_df = pd.DataFrame({column: column_complexities(np.asarray(dataframe[column]))
+                                    for column in COLUMNS_TO_PROCESS})
 
-    for start in range(0, len(data) - num_samples + 1, step_size * sample_rate):
-        windowed_data.append(data[start:start + num_samples])
-
-    return windowed_data
+    graph_and_save_complexities(complexities_df, output_file)
 
 
-def read_csv_columns(file_path, column_names):
+def stream_complexities(csv_file):
     """
-    Read specified columns from a CSV file.
+    Calculate complexities for each column while streaming the CSV file, holding only
+    STREAM_BATCH windows at a time (per-window thresholds only).
     """
-    try:
-        data = pd.read_csv(file_path, usecols=column_names)
-        return data
-    except Exception as e:
-        print(f"Error reading CSV file: {e}")
-        sys.exit(1)
+    num_samples = WINDOW_SIZE * SAMPLE_RATE
+    step = (WINDOW_SIZE - STEP_SIZE) * SAMPLE_RATE
+    batches, batch = [], []
+    # Each channel's warm-started chain runs on from one batch to the next
+    seeds = [{} for column in COLUMNS_TO_PROCESS]
 
+    def flush():
+        # channels x windows x samples
+        windows = np.stack(batch).transpose(2, 0, 1)
+        batches.append(np.array([window_complexities(channel, seeds[k]) for k, channel in enumerate(windows)]).T)
+        batch.clear()
 
+    for start, window in stream_windows(csv_file, COLUMNS_TO_PROCESS, num_samples, step):
+        batch.append(window)
+        if len(batch) == STREAM_BATCH:
+            flush()
+    if batch:
+        flush()
 
+    complexities = np.concatenate(batches) if batches else np.zeros((0, len(COLUMNS_TO_PROCESS)))
+    return pd.DataFrame(complexities, columns=COLUMNS_TO_PROCESS)
 
-def calculate_and_graph_complexities(dataframe, output_file):
+
+def graph_and_save_complexities(complexities_df, output_file):
     """
-    Calculate complexities for each column, graph the results, and save to a CSV.
+    Graph the complexities of each column and save them to a CSV.
     """
-    plt.figure()
-    complexities_dict = {}
-
-    for column in COLUMNS_TO_PROCESS:
-        data = dataframe[column].values
-        windowed_data = sliding_window_process(data, WINDOW_SIZE, STEP_SIZE, SAMPLE_RATE)
-        complexities = []
-
-        for window in windowed_data:
-            binary_string = binarise(window)
-            complexity = calculate(binary_string, DL, SIGMA)
-            complexities.append(complexity)
+    with stage_timer("plot"):
+        plt.figure()
 
-        complexities_dict[column] = complexities
-        plt.plot(complexities, label=column)
+        for column in COLUMNS_TO_PROCESS:
+            plt.plot(complexities_df[column].values, label=column)
 
-    plt.xlabel('Window')
-    plt.ylabel('Complexity')
-    plt.title('Complexity')
-    plt.legend()
-    #plt.show() ## Uncomment to show the plot of each EEG file
+        plt.xlabel('Window')
+        plt.ylabel('Complexity')
+        plt.title('Complexity')
+        plt.legend()
+        #plt.show() ## Uncomment to show the plot of each EEG file
 
-    complexities_df = pd.DataFrame(complexities_dict)
-    complexities_df.to_csv(output_file, index=False)
+    with stage_timer("write_csv"):
+        complexities_df.to_csv(output_file, index=False)
 
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python program.py <path_to_folder>")
+def share_voltages(csv_file, chunksize=1 << 16):
+    """
+    Read the voltages of a CSV file into a channels x samples matrix in shared memory,
+    so workers can view each channel without it being copied to them.
+    The matrix is sized from the file's line count and filled chunk by chunk, so only the shared copy is held.
+    """
+    with open(csv_file) as f:
+        length = sum(1 for line in f) - 1
+    shape = (len(COLUMNS_TO_PROCESS), max(0, length))
+    shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 8))
+    voltages = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    start = 0
+    try:
+        with stage_timer("read_csv"):
+            for chunk in pd.read_csv(csv_file, usecols=COLUMNS_TO_PROCESS, chunksize=chunksize):
+                for channel, column in enumerate(COLUMNS_TO_PROCESS):
+                    voltages[channel, start:start + len(chunk)] = chunk[column].to_numpy(dtype=float)
+                start += len(chunk)
+    except Exception as e:
+        del voltages
+        shm.close()
+        shm.unlink()
+        print(f"Error reading CSV file: {e}")
         sys.exit(1)
+    if start < shape[1]:
+        # Blank lines are not samples, so the channels are packed down to the samples read
+        flat = voltages.reshape(-1)
+        for channel in range(1, shape[0]):
+            flat[channel * start:(channel + 1) * start] = voltages[channel, :start]
+        shape = (shape[0], start)
+        del flat
+    del voltages
+    return shm, shape
 
-    folder_path = sys.argv[1]
+
+def shared_column_complexities(name, shape, channel):
+    """
+    Calculate the complexity of each window of one channel of a shared voltage matrix.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        voltages = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        complexities = column_complexities(voltages[channel])
+        del voltages
+    finally:
+        shm.close()
+    return complexities
+
+
+def stored_column_complexities(csv_file, column):
+    """
+    Calculate the complexity of each window of one channel of a file's binary store.
+    """
+    return column_complexities(np.asarray(open_voltages(csv_file, [column])[column]))
+
+
+def process_files_parallel(csv_files, workers):
+    """
+    Spread the (file, channel) work units over a pool of worker processes, writing each file's
+    complexities in file order and COLUMNS_TO_PROCESS order once all of its channels are done.
+    Each file's voltages are held once, in shared memory, while its channels are processed, unless
+    the file has a binary store, which workers open themselves.
+    """
+    # Enough files are read ahead to keep every worker busy, but no more, to bound memory
+    lookahead = max(2, -(-workers // len(COLUMNS_TO_PROCESS)) + 1)
+    pending = deque()
+
+    def finish(output_file, shm, futures):
+        try:
+            complexities_df = pd.DataFrame({column: futures[column].result() for column in COLUMNS_TO_PROCESS})
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        graph_and_save_complexities(complexities_df, output_file)
+
+    if CACHE_FILE:
+        # The cache is created and switched to write-ahead logging once, here, before workers open it together
+        ResultCache(CACHE_FILE, CACHE_ENTRIES).close()
+
+    if os.name == "posix":
+        # Workers started before any shared block exists must share this process's resource tracker,
+        # rather than each starting one that reports the blocks they attach to as leaked
+        resource_tracker.ensure_running()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            for csv_file in csv_files:
+                output_file = os.path.join(OUTPUT_FOLDER, os.path.basename(csv_file).replace('.csv', '_complexity.csv'))
+                if open_voltages(csv_file, COLUMNS_TO_PROCESS) is not None:
+                    shm = None
+                    futures = {column: pool.submit(stored_column_complexities, csv_file, column)
+                               for column in COLUMNS_TO_PROCESS}
+                else:
+                    shm, shape = share_voltages(csv_file)
+                    futures = {column: pool.submit(shared_column_complexities, shm.name, shape, channel)
+                               for channel, column in enumerate(COLUMNS_TO_PROCESS)}
+                pending.append((output_file, shm, futures))
+                while len(pending) >= lookahead:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+        finally:
+            # Shared blocks of files left unfinished by an error are still released
+            for output_file, shm, futures in pending:
+                for future in futures.values():
+                    future.cancel()
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+
+def process_files(args):
+    """
+    Calculate the complexities of every CSV file in the folder.
+    """
     # Ensure the output folder exists
     if not os.path.exists(OUTPUT_FOLDER):
         os.makedirs(OUTPUT_FOLDER)
-    
+
+    csv_files = glob.glob(os.path.join(args.folder_path, '*.csv'))
+    if args.workers > 1:
+        process_files_parallel(csv_files, args.workers)
+        return
+
     # Process all CSV files in the folder
-    for csv_file in glob.glob(os.path.join(folder_path, '*.csv')):
+    for csv_file in csv_files:
         output_file = os.path.join(OUTPUT_FOLDER, os.path.basename(csv_file).replace('.csv', '_complexity.csv'))
+        voltages = open_voltages(csv_file, COLUMNS_TO_PROCESS)
+        if voltages is not None:
+            # A binary store is read channel by channel from its memory maps
+            calculate_and_graph_complexities(voltages, output_file)
+            continue
+        if THRESHOLD == "window":
+            # Per-window thresholds need only the samples of the windows in hand, so the file is streamed
+            graph_and_save_complexities(stream_complexities(csv_file), output_file)
+            continue
         dataframe = read_csv_columns(csv_file, COLUMNS_TO_PROCESS)
         calculate_and_graph_complexities(dataframe, output_file)
-    
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate the complexity of every EEG CSV file in a folder.")
+    parser.add_argument("folder_path", help="Path to the folder of EEG CSV files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, each taking one (file, channel) at a time")
+    parser.add_argument("--instrument", metavar="REPORT",
+                        help="Save the time spent in each stage and the counts of every state collapse to a JSON "
+                             "file (stages run by worker processes are not recorded)")
+    args = parser.parse_args()
+
+    if args.instrument:
+        start_instrumentation()
+    if MEMO_BYTES:
+        start_collapse_memo(MEMO_BYTES)
+    try:
+        process_files(args)
+    finally:
+        memo = stop_collapse_memo()
+        if args.instrument and memo is not None:
+            print(f"collapse memo: {memo['hits']} hits, {memo['misses']} misses")
+        if args.instrument:
+            report = stop_instrumentation(args.instrument)
+            for stage, timing in report["stages"].items():
+                print(f"{stage}: {timing['seconds']:.3f} s over {timing['calls']} calls")
+            totals = report["totals"]
+            if totals.get("collapses"):
+                print(f"pair tests: {totals['pair_comparisons'] / totals['collapses']:.1f} per window "
+                      f"over {totals['collapses']} windows")
+
 
 if __name__ == "__main__":
     main()
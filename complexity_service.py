@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from main import *
+
+# Global variables
+SOCKET_PATH = "/tmp/complexity.sock"  # Unix socket the service listens on
+MAX_PENDING = 64  # Requests queued before connections stop being read (backpressure)
+MAX_REQUEST_ITEMS = 4096  # Most windows or sequences in one request
+MAX_REQUEST_BYTES = 1 << 28  # Longest request line accepted
+BATCH_ITEMS = 1024  # Most windows or sequences gathered into one batch
+BATCH_DELAY = 0.005  # Seconds to wait for more requests to join a batch
+
+
+def run_batch(kind, dl, sigma, method, mode, items):
+    """
+    Calculate the complexities of a batch of windows or binarised sequences sharing the same parameters.
+    """
+    if kind == "windows":
+        if method == "overlapping":
+            return calculate_batch(np.array(items, dtype=float), dl, sigma, method, mode).tolist()
+        return [calculate(binarise(np.array(window, dtype=float), mode), dl, sigma, method, engine="numpy")
+                for window in items]
+    if kind == "sequences":
+        return [calculate(sequence, dl, sigma, method, engine="numpy") for sequence in items]
+    # bidirectional complexities of binarised sequences, as [forward, reverse, bidirectional]
+    return [list(calculate_bd(sequence, dl, sigma, method, engine="numpy")) for sequence in items]
+
+
+class ComplexityService:
+    """
+    Gather the requests of every connection into batches and calculate them in a pool of processes.
+    """
+
+    def __init__(self, workers):
+        self.queue = asyncio.Queue(maxsize=MAX_PENDING)
+        self.pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        # one calculation per worker at a time, so batches wait (and grow) while the pool is busy
+        self.workers = max(workers, 1)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.tasks = set()
+
+    async def handle(self, reader, writer):
+        """
+        Answer each line of JSON sent by a client, in order, with a line of JSON.
+        """
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # the request is longer than MAX_REQUEST_BYTES, and the connection cannot be resynchronised
+                response = {"error": f"Requests are limited to {MAX_REQUEST_BYTES} bytes"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                break
+            if not line:
+                break
+            try:
+                response = await self.submit(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": str(e)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+
+    async def submit(self, request):
+        """
+        Queue one request, waiting for room in the queue, and return its response.
+        """
+        kind = request.get("kind", "windows")
+        if kind not in ("windows", "sequences", "bidirectional"):
+            raise ValueError(f"Unknown kind {kind}")
+        items = request["items"]
+        if not isinstance(items, list) or not items:
+            raise ValueError("items must be a non-empty list")
+        if len(items) > MAX_REQUEST_ITEMS:
+            raise ValueError(f"At most {MAX_REQUEST_ITEMS} items per request")
+        # a bad request is refused here, before it can share a batch with (and fail) the requests of other clients
+        if kind == "windows":
+            try:
+                items = np.array(items, dtype=float)
+            except (ValueError, TypeError):
+                raise ValueError("Windows must be lists of numbers, all of the same length")
+            if items.ndim != 2 or items.shape[1] == 0:
+                raise ValueError("Windows must be lists of numbers, all of the same length")
+        elif not all(isinstance(item, str) and item and not item.strip("01") for item in items):
+            raise ValueError("Sequences must be non-empty strings of 0's and 1's")
+        dl = int(request["lambda"])
+        if not 1 <= dl <= MAX_CODE_LAMBDA:
+            # the service calculates with the integer code engines, which hold states in int64 codes
+            raise ValueError(f"lambda must be between 1 and {MAX_CODE_LAMBDA}")
+        method = request.get("method", "overlapping")
+        if method not in ("overlapping", "nonoverlapping"):
+            raise ValueError(f"Unknown method {method}")
+        mode = request.get("mode", "median")
+        if mode not in ("median", "mean"):
+            raise ValueError(f"Unknown binarisation mode {mode}")
+        key = (kind, dl, float(request.get("sigma", 0.05)), method, mode)
+        if kind == "windows":
+            # windows of different lengths cannot share a batch
+            key += (items.shape[1],)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, items, future))
+        complexities = await future
+        return {"id": request.get("id"), "complexities": complexities}
+
+    async def batch(self):
+        """
+        Take the queued requests, gathering those with the same parameters into one calculation.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            waiting = [await self.queue.get()]
+            count = len(waiting[0][1])
+            deadline = loop.time() + BATCH_DELAY
+            while count < BATCH_ITEMS:
+                try:
+                    waiting.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                count += len(waiting[-1][1])
+            groups = defaultdict(list)
+            for key, items, future in waiting:
+                groups[key].append((items, future))
+            for key, requests in groups.items():
+                # each group is split between the workers, each chunk starting as soon as a worker is free
+                items = [item for request_items, future in requests for item in request_items]
+                size = -(-len(items) // self.workers)
+                chunks = []
+                for start in range(0, len(items), size):
+                    await self.slots.acquire()
+                    chunks.append(self.start(self.calculate(key, items[start:start + size])))
+                self.start(self.deliver(requests, chunks))
+
+    def start(self, coroutine):
+        """
+        Run a coroutine as a task, keeping a reference to it until it is done.
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def calculate(self, key, items):
+        """
+        Calculate one chunk of a group in the pool, freeing its worker's slot when done.
+        """
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, run_batch, *key[:5], items)
+        finally:
+            self.slots.release()
+
+    async def deliver(self, requests, chunks):
+        """
+        Answer each request of a group with its part of the group's results.
+        """
+        try:
+            results = [result for chunk in await asyncio.gather(*chunks) for result in chunk]
+        except Exception as e:
+            for request_items, future in requests:
+                if not future.done():
+                    future.set_exception(ValueError(str(e)))
+            return
+        start = 0
+        for request_items, future in requests:
+            if not future.done():
+                future.set_result(results[start:start + len(request_items)])
+            start += len(request_items)
+
+
+class ComplexityClient:
+    """
+    Connect to a running complexity service, sending one request at a time.
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile("rwb")
+        self.requests = 0
+
+    def request(self, kind, items, dl, sigma=0.05, method="overlapping", mode="median"):
+        self.requests += 1
+        request = {"id": self.requests, "kind": kind, "items": items, "lambda": dl, "sigma": sigma,
+                   "method": method, "mode": mode}
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["complexities"]
+
+    def calculate(self, windows, dl, sigma=0.05, method="overlapping", mode="median"):
+        """
+        Find the Statistical Complexity of each window of continuous data.
+        """
+        return self.request("windows", np.asarray(windows, dtype=float).tolist(), dl, sigma, method, mode)
+
+    def calculate_sequences(self, sequences, dl, sigma=0.05, method="overlapping"):
+        """
+        Find the Statistical Complexity of each binarised sequence (string of 0's and 1's).
+        """
+        return self.request("sequences", list(sequences), dl, sigma, method)
+
+    def calculate_bd(self, sequences, dl, sigma=0.05, method="overlapping"):
+        """
+        Find the forward, reverse and bidirectional Statistical Complexity of each binarised sequence.
+        """
+        return self.request("bidirectional", list(sequences), dl, sigma, method)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+async def serve(path, workers):
+    service = ComplexityService(workers)
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(service.handle, path, limit=MAX_REQUEST_BYTES)
+    print(f"Serving complexities on {path}", file=sys.stderr)
+    # Terminating the service shuts it down as cleanly as an interrupt
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    batcher = asyncio.create_task(service.batch())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+        for task in list(service.tasks):
+            task.cancel()
+        if service.pool is not None:
+            service.pool.shutdown()
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Statistical Complexity calculations on a Unix socket.")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Path of the Unix socket")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes (0 calculates in a thread of the service)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.socket, args.workers))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
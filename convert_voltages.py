@@ -0,0 +1,20 @@
+import argparse
+
+from main import convert_voltages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert EEG CSV files into binary stores of memory-mapped channels.")
+    parser.add_argument("file_paths", nargs="+", help="Paths to the EEG CSV files")
+    parser.add_argument("--columns", nargs="+", help="Channels to convert (all numeric columns by default)")
+    parser.add_argument("--sample-rate", type=int, help="Sample rate in Hz, recorded in the store's metadata")
+    parser.add_argument("--float32", action="store_true", help="Store the voltages as float32 rather than float64")
+    args = parser.parse_args()
+
+    for file_path in args.file_paths:
+        store = convert_voltages(file_path, args.columns, args.sample_rate, "float32" if args.float32 else "float64")
+        print(f"Saved binary store of {file_path} to {store}")
+
+
+if __name__ == "__main__":
+    main()
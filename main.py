@@ -1,20 +1,36 @@
 import numpy as np
 from copy import deepcopy
+from time import perf_counter
+
+#version of the calculations, to be increased whenever a change alters their results (invalidating cached results)
+ALGORITHM_VERSION = 2
+#largest code space counted with a dense table (np.bincount), larger ones are counted by sorting the codes seen
+DENSE_CODES = 1 << 20
+#largest lambda of the integer code engines, whose codes hold dl bits below a leading tag bit (or dl+1 bits) in an int64
+MAX_CODE_LAMBDA = 62
 
 def calculate(istring: str, dl: int, sigma: float = 0.05, method: str = "overlapping",
-                                     states_provided: bool = False, return_states: bool = False):
+                                     states_provided: bool = False, return_states: bool = False,
+                                     engine: str = "dict"):
     """
     Find the (forwards) Statistical Complexity of an input string for given lambda and sigma values
+    engine="suffix" uses suffix_complexity for overlapping states with sigma <= 0.5 (and the numpy engine otherwise)
     """
+    if(engine=="suffix"):
+        if(method=="overlapping" and sigma<=0.5 and len(istring)>dl and type(states_provided)==bool
+                and return_states==False):
+            return suffix_complexity(istring,dl,sigma)
+        engine = "numpy"
     #if states are not provided, find them, otherwise declare it
     if(type(states_provided)==bool):
         #first, find all states from the input string and the probabilities of presents
-        initial_states = find_states(istring,dl,method=method)
+        initial_states = find_states(istring,dl,method=method,as_table=(engine=="numpy"))
         #next, collapse states which have similar probability distributions
-        refined_states = collapse_states(initial_states,dl,sigma)
+        refined_states = collapse_states(initial_states,dl,sigma,engine=engine)
     else:
         #collapse the states based purely on keynames (already done)
         initial_states,refined_states = states_provided,states_provided
+    start = perf_counter() if _instrumentation is not None else None
     #convert this into a list of probabilities
     probs = collapse_past(refined_states)
     #create an array of logbase2 probabilities for use in the calculation
@@ -23,10 +39,15 @@ def calculate(istring: str, dl: int, sigma: float = 0.05, method: str = "overlap
     complexity = 0.0
     for i in range(len(probs)):
         complexity -= probs[i]*logprobs[i]
+    if(start is not None):
+        _instrumentation.add_time("complexity",perf_counter()-start)
     #if states are not desired, only return complexity
     if(return_states==False):
         return complexity
     else:
+        if(isinstance(refined_states,StateTable)):
+            #callers asking for the states get them as dictionaries
+            refined_states,initial_states = refined_states.to_dict(),initial_states.to_dict()
         return complexity,refined_states,initial_states
 
 def calculate_multi(istrings,dl: int, sigma: float = 0.05):
@@ -39,23 +60,279 @@ def calculate_multi(istrings,dl: int, sigma: float = 0.05):
     return output
 
 def calculate_bd(istring: str, dl: int, sigma: float = 0.05, method: str ="overlapping",
-                              record_states: bool = False):
+                              record_states: bool = False, engine: str = "dict"):
     """
     Find the forwards, reverse and bidirectional statistical complexity for a string
     """
-    #find statistical complexity of forward string and the refined states
-    f_sc,f_states,f_states_raw = calculate(istring,dl,sigma,return_states=True,method=method)
-    #find complexity of backwards string
-    b_sc,b_states,b_states_raw = calculate(istring[::-1],dl,sigma,return_states=True,method=method)
+    if(engine=="numpy"):
+        #keep the states as tables rather than converting them to dictionaries
+        if(method=="overlapping" and len(istring)>dl):
+            f_states_raw,b_states_raw = bidirectional_tables(istring,dl)
+        else:
+            f_states_raw = find_states(istring,dl,method=method,as_table=True)
+            b_states_raw = find_states(istring[::-1],dl,method=method,as_table=True)
+        f_states,b_states = collapse_states(f_states_raw,dl,sigma),collapse_states(b_states_raw,dl,sigma)
+        f_sc,b_sc = calculate("",dl,sigma,states_provided=f_states),calculate("",dl,sigma,states_provided=b_states)
+    elif(method=="overlapping" and len(istring)>dl and dl<=MAX_CODE_LAMBDA):
+        #the raw states of both directions come from one count, and are collapsed as dictionaries
+        f_table,b_table = bidirectional_tables(istring,dl)
+        f_states_raw,b_states_raw = f_table.to_dict(),b_table.to_dict()
+        f_states,b_states = collapse_states(f_states_raw,dl,sigma),collapse_states(b_states_raw,dl,sigma)
+        f_sc,b_sc = calculate("",dl,sigma,states_provided=f_states),calculate("",dl,sigma,states_provided=b_states)
+    else:
+        #find statistical complexity of forward string and the refined states
+        f_sc,f_states,f_states_raw = calculate(istring,dl,sigma,return_states=True,method=method)
+        #find complexity of backwards string
+        b_sc,b_states,b_states_raw = calculate(istring[::-1],dl,sigma,return_states=True,method=method)
     #collapse the states of forward and reverse complexity based purely on key names
     bd_s = collapse_keys(f_states,b_states)
     #find complexity of bi-directional machine
-    bd_sc,bd_states,bd_states_raw = calculate("",dl,sigma,states_provided = bd_s,return_states = True)
+    bd_sc,bd_states,bd_states_raw = calculate("",dl,sigma,states_provided = bd_s),bd_s,bd_s
     if(record_states==False):
         return f_sc,b_sc,bd_sc
     else:
         return f_sc,b_sc,bd_sc,len(f_states),len(b_states),len(bd_states),len(f_states_raw),len(b_states_raw),len(bd_states_raw)
 
+def bidirectional_tables(istring, dl: int):
+    """
+    Find the raw (overlapping) states of a string and of the reversed string from one count of its (dl+1)-bit codes
+    """
+    check_code_lambda(dl)
+    if(isinstance(istring,BitSequence)):
+        grams = istring.codes(dl+1)
+    else:
+        grams = rolling_codes(to_bits(istring),dl+1)
+    codes,counts,first,last = count_codes(grams,1 << (dl+1),last=True)
+    # Reversed, each code is read backwards and first occurs where its last forward occurrence was
+    reverse = np.zeros(len(codes),dtype=np.int64)
+    for k in range(dl+1):
+        reverse |= ((codes >> k) & 1) << (dl-k)
+    order,reverse_order = np.argsort(first),np.argsort(-last)
+    return (StateTable.from_codes(codes[order],counts[order],dl),
+            StateTable.from_codes(reverse[reverse_order],counts[reverse_order],dl))
+
+def suffix_complexity(istring, dl: int, sigma: float = 0.05):
+    """
+    Find the (forwards, overlapping) Statistical Complexity of an input string for sigma <= 0.5, giving the same value
+    as calculate without comparing every pair of states
+    """
+    # An overlapping past's presents are its last dl-1 bits followed by 0 or 1, so two pasts have the same presents
+    # when they share those bits (a suffix group, of at most 2 pasts) and no presents otherwise. Pasts without shared
+    # presents (or merged with one) differ by at least 0.5, so states only merge within a suffix group, at most once,
+    # and the reference order leaves the unmerged states in order followed by the merged ones in order of their first
+    check_code_lambda(dl)
+    if(isinstance(istring,BitSequence)):
+        grams = istring.codes(dl+1)
+    else:
+        grams = rolling_codes(to_bits(istring),dl+1)
+    codes,counts,first = count_codes(grams,1 << (dl+1))
+    #every observed past, with its transitions to a next bit of 1 and its first occurrence
+    pasts,starts = np.unique(codes >> 1,return_index=True)
+    totals,ones = np.add.reduceat(counts,starts),np.add.reduceat(counts*(codes & 1),starts)
+    first = np.minimum.reduceat(first,starts)
+    p0,p1 = (totals-ones)/totals,ones/totals
+    #suffix groups of two: a past starting with 0 (a) and the same suffix starting with 1 (b)
+    split = np.searchsorted(pasts,1 << (dl-1))
+    _,a,b = np.intersect1d(pasts[:split],pasts[split:]-(1 << (dl-1)),assume_unique=True,return_indices=True)
+    b += split
+    #as calculate_difference: the larger difference in the probability of either present
+    merged = np.maximum(np.abs(p0[a]-p0[b]),np.abs(p1[a]-p1[b]))<sigma
+    a,b = a[merged],b[merged]
+    alone = np.ones(len(pasts),dtype=bool)
+    alone[a],alone[b] = False,False
+    state_totals = np.concatenate([totals[alone][np.argsort(first[alone],kind="stable")],
+                                   (totals[a]+totals[b])[np.argsort(np.minimum(first[a],first[b]),kind="stable")]])
+    probs = state_totals/state_totals.sum()
+    #subtracting each state's term in turn, as calculate does
+    return np.subtract.accumulate(np.concatenate([[0.],probs*np.log2(probs)]))[-1]
+
+def calculate_lambdas(istring, dls, sigma: float = 0.05, method: str = "overlapping"):
+    """
+    Find the (forwards) Statistical Complexity of an input string for each lambda in dls, counting the transitions
+    once at the largest lambda (overlapping method) and marginalising them for the smaller ones
+    A list of sigmas gives an array shaped (lambdas, sigmas), collapsing each lambda's states with sweep_complexities
+    """
+    bits = to_bits(istring)
+    top = max(dls)
+    check_code_lambda(top)
+    if(method!="overlapping" or len(bits)<=top):
+        if(np.ndim(sigma)>0):
+            return np.array([sweep_complexities(find_states(bits,dl,method=method,as_table=True),sigma) for dl in dls])
+        return np.array([calculate(bits,dl,sigma,method=method,engine="numpy") for dl in dls])
+    grams = rolling_codes(bits,top+1)
+    codes,counts,first = count_codes(grams,1 << (top+1))
+    output = []
+    for dl in dls:
+        # a (dl+1)-bit code is the start of the longer codes, which cover every position but the last top-dl
+        tail = rolling_codes(bits[len(grams):],dl+1)
+        dl_codes,rows = np.unique(np.concatenate([codes >> (top-dl),tail]),return_inverse=True)
+        dl_counts,dl_first = np.zeros(len(dl_codes),dtype=np.int64),np.full(len(dl_codes),len(bits))
+        np.add.at(dl_counts,rows,np.concatenate([counts,np.ones(len(tail),dtype=np.int64)]))
+        np.minimum.at(dl_first,rows,np.concatenate([first,len(grams)+np.arange(len(tail))]))
+        order = np.argsort(dl_first)
+        table = StateTable.from_codes(dl_codes[order],dl_counts[order],dl)
+        if(np.ndim(sigma)>0):
+            output.append(sweep_complexities(table,sigma))
+        else:
+            output.append(calculate("",dl,sigma,states_provided=collapse_states(table,dl,sigma)))
+    return np.array(output)
+
+def calculate_sliding(istring, dl: int, sigma: float = 0.05, window: int = 5000, step: int = 500,
+                                      warm: bool = False):
+    """
+    Find the (forwards, overlapping) Statistical Complexity of every window of an input string, giving the same values
+    as calculate on each window but keeping the transition counts from one window to the next
+    warm=True seeds each window's collapse with the previous window's states (see warm_collapse)
+    """
+    if(not isinstance(istring,BitSequence)):
+        istring = to_bits(istring)
+    starts = range(0,len(istring)-window+1,step)
+    #the counts kept between windows are a dense table, so large lambdas count each window sparsely instead
+    if(window<=dl or (1 << (dl+1))>max(DENSE_CODES,len(istring))):
+        if(not warm):
+            return np.array([calculate(istring[start:start+window],dl,sigma,engine="numpy") for start in starts])
+        output,seed = [],None
+        for start in starts:
+            seed = collapse_states(find_states(istring[start:start+window],dl,method="overlapping",as_table=True),
+                                   dl,sigma,previous=seed)
+            output.append(calculate("",dl,sigma,states_provided=seed))
+        return np.array(output)
+    #every (dl+1)-bit window of the string is one transition, and a window holds span of them
+    grams = istring.codes(dl+1) if isinstance(istring,BitSequence) else rolling_codes(istring,dl+1)
+    pasts,span = grams >> 1,window-dl
+    # Pasts must be ordered by their first occurrence in each window, so keep the first occurrence of every past from
+    # the window start onwards, moving it to the next occurrence of the same past once it leaves the window
+    order = np.argsort(pasts,kind="stable")
+    same = pasts[order[1:]]==pasts[order[:-1]]
+    following = np.full(len(pasts),len(pasts))
+    following[order[:-1][same]] = order[1:][same]
+    first = np.full(1 << dl,len(pasts))
+    np.minimum.at(first,pasts,np.arange(len(pasts)))
+    counts,previous,output,seed = None,0,[],None
+    for start in starts:
+        if(counts is None or start-previous>=span):
+            counts = np.bincount(grams[start:start+span],minlength=1 << (dl+1))
+        else:
+            #only the transitions that left or entered the window change the counts
+            np.subtract.at(counts,grams[previous:start],1)
+            np.add.at(counts,grams[previous+span:start+span],1)
+        if(start>previous):
+            leaving = pasts[previous:start][::-1]
+            codes,last = np.unique(leaving,return_index=True)
+            first[codes] = following[start-1-last]
+        table = StateTable.from_grams(counts,first,dl)
+        refined = collapse_states(table,dl,sigma,previous=seed if warm else None)
+        output.append(calculate("",dl,sigma,states_provided=refined))
+        previous,seed = start,refined
+    return np.array(output)
+
+def calculate_batch(windows, dl: int, sigma: float = 0.05, method: str = "overlapping", mode: str = "median",
+                                    batch_size: int = 256, warm: bool = False, seeds: dict = None):
+    """
+    Find the (forwards) Statistical Complexity of every window in a 2D (windows x samples) or 3D
+    (channels x windows x samples) array of continuous data, binarising and counting batch_size windows at a time
+    Returns an array of complexities shaped (windows,) or (windows, channels), one column per channel
+    warm=True seeds each window's collapse with the previous window's states of the same channel (see warm_collapse),
+    and seeds (a dictionary) keeps each channel's last states between calls, so windows passed in several calls are
+    seeded as one chain
+    """
+    windows = np.asarray(windows)
+    output = np.empty(windows.shape[:-1])
+    for channel in np.ndindex(windows.shape[:-2]):
+        seed = seeds.get(channel) if(warm and seeds is not None) else None
+        for start in range(0,windows.shape[-2],batch_size):
+            bits = binarise_bits(windows[channel][start:start+batch_size],mode,axis=1)
+            if(method=="overlapping" and bits.shape[1]>dl):
+                tables = batch_tables(bits,dl)
+            else:
+                tables = [find_states(row,dl,method=method,as_table=True) for row in bits]
+            totals = []
+            for table in tables:
+                refined = collapse_states(table,dl,sigma,previous=seed)
+                totals.append(refined.totals)
+                seed = refined if warm else None
+            output[channel][start:start+len(bits)] = totals_to_complexities(totals)
+        if(warm and seeds is not None):
+            seeds[channel] = seed
+    #one column per channel, as the complexity CSVs are laid out
+    return output.T if output.ndim==2 else output
+
+def calculate_sigmas(windows, dl: int, sigmas, method: str = "overlapping", mode: str = "median",
+                                     batch_size: int = 256):
+    """
+    Find the (forwards) Statistical Complexity of every window in a 2D (windows x samples) array of continuous data
+    for every sigma in sigmas, finding each window's states once
+    Returns an array of complexities shaped (windows, sigmas)
+    """
+    windows = np.asarray(windows)
+    output = np.empty([len(windows),len(sigmas)])
+    for start in range(0,len(windows),batch_size):
+        bits = binarise_bits(windows[start:start+batch_size],mode,axis=1)
+        if(method=="overlapping" and bits.shape[1]>dl):
+            tables = batch_tables(bits,dl)
+        else:
+            tables = [find_states(row,dl,method=method,as_table=True) for row in bits]
+        for i,table in enumerate(tables):
+            output[start+i] = sweep_complexities(table,sigmas)
+    return output
+
+def sweep_complexities(table, sigmas):
+    """
+    Find the Statistical Complexity of a table of raw states collapsed with each sigma in sigmas (see merge_sweep)
+    """
+    if(_instrumentation is not None and "collapse_states" not in _instrumentation.running):
+        return _instrumentation.timed("collapse_states",sweep_complexities,table,sigmas)
+    output = np.empty(len(sigmas))
+    for k,(merges,survivors) in enumerate(merge_sweep(table,sigmas)):
+        totals = table.totals.copy()
+        for row,partner in merges:
+            totals[row] += totals[partner]
+        output[k] = probs_to_complexity(totals[survivors]/totals[survivors].sum())
+    return output
+
+def batch_tables(bits, dl: int):
+    """
+    Count the overlapping transitions of every row of a 2D array of bits at once, returning one StateTable per row
+    """
+    if(_instrumentation is not None and "find_states" not in _instrumentation.running):
+        return _instrumentation.timed("find_states",batch_tables,bits,dl)
+    check_code_lambda(dl)
+    #each row's codes are offset by the codes before, so a batch too large for an int64 is counted in parts
+    group = max(1,np.iinfo(np.int64).max >> (dl+1))
+    if(bits.shape[0]>group):
+        return [table for start in range(0,bits.shape[0],group) for table in batch_tables(bits[start:start+group],dl)]
+    rows,width = bits.shape[0],bits.shape[1]-dl
+    grams = np.zeros([rows,width],dtype=np.int64)
+    for k in range(dl+1):
+        grams <<= 1
+        grams |= bits[:,k:k+width]
+    #offset each row's codes so one count covers the whole batch
+    size = 1 << (dl+1)
+    if(rows>1):
+        grams += (np.arange(rows,dtype=np.int64)*size)[:,None]
+    codes,counts,first = count_codes(grams.ravel(),rows*size)
+    #ordered by first occurrence, the codes of each row follow those of the row before
+    order = np.argsort(first)
+    codes,counts = codes[order] & (size-1),counts[order]
+    bounds = np.searchsorted(first[order],np.arange(rows+1)*width)
+    return [StateTable.from_codes(codes[bounds[row]:bounds[row+1]],counts[bounds[row]:bounds[row+1]],dl)
+            for row in range(rows)]
+
+def totals_to_complexities(totals):
+    """
+    Calculate the Statistical Complexity of many machines at once, given a list of arrays of their state totals
+    """
+    lengths = np.array([len(total) for total in totals])
+    if(len(totals)==0):
+        return np.zeros(0)
+    counts = np.concatenate(totals).astype(float)
+    starts = np.concatenate([[0],np.cumsum(lengths)[:-1]])
+    probs = counts/np.repeat(np.add.reduceat(counts,starts),lengths)
+    #one row per machine, subtracting its terms one by one in order, exactly as calculate sums them
+    terms = np.zeros([len(totals),lengths.max()+1])
+    terms[np.repeat(np.arange(len(totals)),lengths),np.arange(len(counts))-np.repeat(starts,lengths)+1] = probs*np.log2(probs)
+    return np.subtract.accumulate(terms,axis=1)[:,-1]
+
 #Find multiple statistical complexities for forwards, reverse and bidirectional
 def calculate_bd_multi(istrings,dl: int, sigma: float = 0.05):
     """
@@ -67,10 +344,21 @@ def calculate_bd_multi(istrings,dl: int, sigma: float = 0.05):
     return output
 
 #input string, desired lambda
-def find_states(istring: str, dl: int, method: str = "nonoverlapping"):
+def find_states(istring: str, dl: int, method: str = "nonoverlapping", engine: str = "dict",
+                                          as_table: bool = False):
     """
     Find the states present in a given input string, outputting the past states, their frequency, and their present state distributions
+    engine="numpy" counts the states with integer codes instead of walking the string (same output)
+    as_table=True returns the states as a StateTable (always counted with integer codes)
     """
+    if(_instrumentation is not None and "find_states" not in _instrumentation.running):
+        return _instrumentation.timed("find_states",find_states,istring,dl,method,engine,as_table)
+    if(engine=="numpy" or as_table):
+        table = StateTable.from_counts(*count_transitions(istring,dl,method),dl)
+        return table if as_table else table.to_dict()
+    if(not isinstance(istring,str)):
+        #arrays of bits are walked through their string view
+        istring = bits_to_string(istring)
     #variables used
     i,output_dict = 0,{}
     ## main loop of identifying past and present states
@@ -123,10 +411,453 @@ def find_states(istring: str, dl: int, method: str = "nonoverlapping"):
                 output_dict[past][present]/=output_dict[past]["total"]
     return output_dict
 
-def collapse_states(odict: dict, dl: int, sigma: float = 0.1):
+def check_code_lambda(dl: int):
+    """
+    Raise a ValueError for a lambda too large for the integer code engines (the dict engine handles any lambda)
+    """
+    if(dl>MAX_CODE_LAMBDA):
+        raise ValueError("lambda {} is too large for the integer code engines (at most {}), use engine=\"dict\"".format(dl,MAX_CODE_LAMBDA))
+
+def to_bits(istring):
+    """
+    Convert a string of 0's and 1's into a uint8 array of bits (arrays of bits are passed through)
+    """
+    if(isinstance(istring,str)):
+        return np.frombuffer(istring.encode("ascii"),dtype=np.uint8)-ord("0")
+    return np.asarray(istring,dtype=np.uint8)
+
+def tag_codes(codes, length):
+    """
+    Mark integer codes of bit strings with a leading 1 bit so that codes of different lengths never collide
+    """
+    return codes | (1 << length)
+
+def code_to_string(code: int):
+    """
+    Convert a tagged integer code back into its string of 0's and 1's
+    """
+    return bin(code)[3:]
+
+def rolling_codes(bits, width: int, stride: int = 1):
+    """
+    Pack every window of width bits (starting every stride bits) into an integer code using rolling bit shifts
+    """
+    count = (len(bits)-width)//stride+1 if len(bits)>=width else 0
+    codes = np.zeros(count,dtype=np.int64)
+    if(count==0):
+        return codes
+    for k in range(width):
+        codes <<= 1
+        codes |= bits[k:k+(count-1)*stride+1:stride]
+    return codes
+
+def count_transitions(istring, dl: int, method: str = "nonoverlapping"):
+    """
+    Count every (past, present) transition of an input string with integer codes (see count_codes)
+    Returns tagged past codes, tagged present codes and counts, ordered by first occurrence
+    """
+    check_code_lambda(dl)
+    bits = to_bits(istring)
+    n = len(bits)
+    # Option 1: Non Overlapping - consecutive dl-bit blocks are (past, present) pairs
+    if(method=="nonoverlapping"):
+        steps = (n-2*dl-1)//dl+1 if n>2*dl else 0
+        # the final step is a full pair only when the string ends exactly on a block boundary
+        i = steps*dl
+        last_past,last_present = bits[i:i+dl],bits[i+dl:i+2*dl]
+        if(len(last_present)==dl):
+            steps += 1
+        blocks = rolling_codes(bits[:(steps+1)*dl],dl,dl)
+        pasts,presents = blocks[:-1],blocks[1:]
+        #a pair is one code while both blocks fit an int64 together, and a row of two codes beyond
+        pairs,size = ((pasts << dl) | presents,1 << (2*dl)) if 2*dl<=63 else (None,None)
+    # Option 2: Overlapping - every (dl+1)-bit window is a past followed by its next bit
+    else:
+        # the final step always completes the last full window here
+        steps = n-dl if n>dl else 0
+        pairs,size = rolling_codes(bits,dl+1),1 << (dl+1)
+        pasts,presents = pairs >> 1,pairs & ((1 << dl)-1)
+        i = steps
+        last_past,last_present = bits[i:i+dl],bits[i+1:i+1+dl]
+    if(steps>0):
+        if(pairs is not None):
+            _,counts,first = count_codes(pairs,size)
+        else:
+            _,first,counts = np.unique(np.stack([pasts,presents],axis=1),axis=0,return_index=True,return_counts=True)
+        order = np.argsort(first)
+        pair_pasts = tag_codes(pasts[first[order]],dl)
+        pair_presents = tag_codes(presents[first[order]],dl)
+        pair_counts = counts[order]
+    else:
+        #the string is too short for a full pair, so only the truncated final state is found
+        pair_pasts = np.array([tag_codes(int(rolling_codes(last_past,len(last_past))[0]),len(last_past))],dtype=np.int64)
+        pair_presents = np.array([tag_codes(int(rolling_codes(last_present,len(last_present))[0]),len(last_present))],dtype=np.int64)
+        pair_counts = np.ones(1,dtype=np.int64)
+    if(steps>0 and method=="nonoverlapping"):
+        #the final nonoverlapping present is usually a truncated block, counted separately
+        if(len(last_present)<dl):
+            pair_pasts = np.append(pair_pasts,tag_codes(int(blocks[-1]),dl))
+            pair_presents = np.append(pair_presents,tag_codes(int(rolling_codes(last_present,len(last_present))[0]),len(last_present)))
+            pair_counts = np.append(pair_counts,1)
+    return pair_pasts,pair_presents,pair_counts
+
+def count_codes(codes, size: int, last: bool = False):
+    """
+    Count the distinct integer codes (all below size) of an array, returning them in increasing order with their counts
+    and the positions of their first occurrences (and of their last occurrences too, with last=True)
+    Small code spaces are counted with a dense np.bincount table, larger ones by sorting (np.unique), which needs memory
+    for the codes seen only
+    """
+    codes = np.asarray(codes,dtype=np.int64)
+    if(size<=max(DENSE_CODES,len(codes))):
+        counts = np.bincount(codes,minlength=size)
+        first = np.full(size,len(codes))
+        np.minimum.at(first,codes,np.arange(len(codes)))
+        seen = np.flatnonzero(counts)
+        if(not last):
+            return seen,counts[seen],first[seen]
+        final = np.full(size,-1)
+        np.maximum.at(final,codes,np.arange(len(codes)))
+        return seen,counts[seen],first[seen],final[seen]
+    seen,first,inverse,counts = np.unique(codes,return_index=True,return_inverse=True,return_counts=True)
+    if(not last):
+        return seen,counts,first
+    final = np.full(len(seen),-1)
+    np.maximum.at(final,inverse,np.arange(len(codes)))
+    return seen,counts,first,final
+
+class BitSequence:
+    """
+    A sequence of bits packed 8 to a byte (np.packbits), usable wherever a string of 0's and 1's is
+    Slicing (including reversal with [::-1]) gives another BitSequence and indexing gives a single bit
+    """
+    __slots__ = ("packed","length")
+
+    def __init__(self, bits=()):
+        bits = to_bits(bits)
+        self.packed,self.length = np.packbits(bits),len(bits)
+
+    @classmethod
+    def from_packed(cls, packed, length: int):
+        """
+        Create a sequence from bytes already packed with np.packbits
+        """
+        sequence = cls.__new__(cls)
+        sequence.packed,sequence.length = np.asarray(packed,dtype=np.uint8),length
+        return sequence
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if(isinstance(key,slice)):
+            start,stop,step = key.indices(self.length)
+            if(step==1):
+                return BitSequence(self.unpack(start,max(start,stop)))
+            return BitSequence(self.unpack()[key])
+        index = key+self.length if key<0 else key
+        if(index<0 or index>=self.length):
+            raise IndexError("BitSequence index out of range")
+        return int(self.packed[index >> 3] >> (7-(index & 7)) & 1)
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.unpack()
+        return bits if dtype is None else bits.astype(dtype,copy=False)
+
+    def __str__(self):
+        return bits_to_string(self.unpack())
+
+    def unpack(self, start: int = 0, stop: int = None):
+        """
+        Unpack bits start to stop into a uint8 array of 0's and 1's
+        """
+        stop = self.length if stop is None else stop
+        first = start >> 3
+        return np.unpackbits(self.packed[first:(stop+7) >> 3])[start-first*8:stop-first*8]
+
+    def codes(self, width: int, stride: int = 1, chunk: int = 1 << 16):
+        """
+        Pack every window of width bits (starting every stride bits) into an integer code, as rolling_codes does,
+        unpacking only chunk bits at a time
+        """
+        count = (self.length-width)//stride+1 if self.length>=width else 0
+        output = np.zeros(count,dtype=np.int64)
+        step = max(1,chunk//stride)
+        for first in range(0,count,step):
+            last = min(first+step,count)
+            bits = self.unpack(first*stride,(last-1)*stride+width)
+            output[first:last] = rolling_codes(bits,width,stride)
+        return output
+
+class StateTable:
+    """
+    Array-backed states: the pasts merged into each state, its present state distribution and its total count
+    Members and distributions are stored row by row in compressed form (pointer, index and value arrays)
+    """
+    __slots__ = ("dl","members","member_ptr","presents","indices","indptr","probs","totals")
+
+    def __init__(self, dl: int, members, member_ptr, presents, indices, indptr, probs, totals):
+        self.dl = dl
+        # tagged codes of the pasts in each state: members[member_ptr[i]:member_ptr[i+1]]
+        self.members,self.member_ptr = np.asarray(members,dtype=np.int64),np.asarray(member_ptr,dtype=np.int64)
+        # tagged codes of the presents, and each state's distribution over them: probs[indptr[i]:indptr[i+1]]
+        self.presents = np.asarray(presents,dtype=np.int64)
+        self.indices,self.indptr = np.asarray(indices,dtype=np.int64),np.asarray(indptr,dtype=np.int64)
+        self.probs,self.totals = np.asarray(probs,dtype=float),np.asarray(totals,dtype=np.int64)
+
+    def __len__(self):
+        return len(self.totals)
+
+    @classmethod
+    def from_counts(cls, pair_pasts, pair_presents, pair_counts, dl: int):
+        """
+        Create a table of raw states from (past, present) transition counts ordered by first occurrence
+        """
+        pasts,first,rows = np.unique(pair_pasts,return_index=True,return_inverse=True)
+        #number states by their first occurrence, as find_states does
+        rank = np.empty(len(pasts),dtype=np.int64)
+        rank[np.argsort(first,kind="stable")] = np.arange(len(pasts))
+        rows = rank[rows]
+        presents,columns = np.unique(pair_presents,return_inverse=True)
+        totals = np.zeros(len(pasts),dtype=np.int64)
+        np.add.at(totals,rows,pair_counts)
+        entries = np.argsort(rows,kind="stable")
+        indptr = np.concatenate([[0],np.cumsum(np.bincount(rows,minlength=len(pasts)))])
+        return cls(dl,pasts[np.argsort(rank)],np.arange(len(pasts)+1),presents,columns[entries],indptr,
+                   pair_counts[entries]/totals[rows[entries]],totals)
+
+    @classmethod
+    def from_grams(cls, counts, first, dl: int):
+        """
+        Create a table of raw states from the counts of every (dl+1)-bit code (overlapping transitions),
+        given the position of each past's first occurrence
+        """
+        observed = np.flatnonzero(counts)
+        observed = observed[np.argsort(first[observed >> 1],kind="stable")]
+        return cls.from_counts(tag_codes(observed >> 1,dl),tag_codes(observed & ((1 << dl)-1),dl),counts[observed],dl)
+
+    @classmethod
+    def from_codes(cls, codes, counts, dl: int):
+        """
+        Create a table of raw states from the counts of the (dl+1)-bit codes (overlapping transitions) seen,
+        ordered by first occurrence
+        """
+        return cls.from_counts(tag_codes(codes >> 1,dl),tag_codes(codes & ((1 << dl)-1),dl),counts,dl)
+
+    @classmethod
+    def from_dict(cls, odict: dict, dl: int):
+        """
+        Create a table from a dictionary of states (as returned by find_states or collapse_states)
+        """
+        check_code_lambda(dl)
+        members,member_ptr,present_keys,indices,indptr,probs,totals = [],[0],{},[],[0],[],[]
+        for past in odict:
+            #merged keys are dl-length pasts joined together
+            if(len(past)>dl and len(past)%dl==0):
+                chunks = [past[i:i+dl] for i in range(0,len(past),dl)]
+            else:
+                chunks = [past]
+            members.extend((1 << len(chunk)) | int(chunk or "0",2) for chunk in chunks)
+            member_ptr.append(len(members))
+            for present in odict[past]:
+                if(present!="total"):
+                    indices.append(present_keys.setdefault(present,len(present_keys)))
+                    probs.append(odict[past][present])
+            indptr.append(len(indices))
+            totals.append(odict[past]["total"])
+        presents = [(1 << len(present)) | int(present or "0",2) for present in present_keys]
+        return cls(dl,members,member_ptr,presents,indices,indptr,probs,totals)
+
+    def keys(self):
+        """
+        Find the dictionary key of each state (its pasts joined together)
+        """
+        members = [code_to_string(code) for code in self.members.tolist()]
+        ptr = self.member_ptr.tolist()
+        return ["".join(members[ptr[i]:ptr[i+1]]) for i in range(len(self))]
+
+    def to_dict(self):
+        """
+        Convert the table into the dictionary of states used by find_states and collapse_states
+        """
+        presents = [code_to_string(code) for code in self.presents.tolist()]
+        indices,probs,ptr = self.indices.tolist(),self.probs.tolist(),self.indptr.tolist()
+        odict = {}
+        for i,key in enumerate(self.keys()):
+            nprobs = {presents[indices[k]]:probs[k] for k in range(ptr[i],ptr[i+1])}
+            nprobs.update({"total":int(self.totals[i])})
+            odict.update({key:nprobs})
+        return odict
+
+    def dense(self):
+        """
+        Expand the present state distributions into a matrix (one row per state, one column per present)
+        """
+        matrix = np.zeros([len(self),len(self.presents)],dtype=float)
+        matrix[np.repeat(np.arange(len(self)),np.diff(self.indptr)),self.indices] = self.probs
+        return matrix
+
+    def member_lists(self):
+        """
+        Split the member pasts into one array per state
+        """
+        ptr = self.member_ptr.tolist()
+        return [self.members[ptr[i]:ptr[i+1]] for i in range(len(self))]
+
+    def merged(self, merges, states, rows):
+        """
+        Create the table left after a sequence of (row, partner) merges: the given rows of the merged distributions
+        (a StateRows), with each row holding the pasts and total counts of every state merged into it
+        """
+        members,totals = self.member_lists(),self.totals.copy()
+        for row,partner in merges:
+            members[row] = np.sort(np.concatenate([members[row],members[partner]]))
+            totals[row] += totals[partner]
+        indices,indptr,values = states.compressed(rows)
+        member_ptr = np.concatenate([[0],np.cumsum([len(members[row]) for row in rows])])
+        member_codes = np.concatenate([members[row] for row in rows]) if len(rows)>0 else []
+        return StateTable(self.dl,member_codes,member_ptr,self.presents,indices,indptr,values,totals[rows])
+
+class StateRows:
+    """
+    Present state distributions of states being merged, kept sparse: one array of presents (in order) and one of
+    probabilities per state, with each state's largest probability, the present it is found at and, for each present,
+    the set of (unmerged) states that have it
+    """
+    __slots__ = ("columns","values","peak","column","holders")
+
+    def __init__(self, indices, indptr, values, width: int):
+        n = len(indptr)-1
+        entry_rows = np.repeat(np.arange(n),np.diff(indptr))
+        order = np.lexsort((indices,entry_rows))
+        indices,values = np.asarray(indices,dtype=np.int64)[order],np.asarray(values,dtype=float)[order]
+        bounds = list(zip(indptr[:-1].tolist(),indptr[1:].tolist()))
+        self.columns,self.values = [indices[a:b] for a,b in bounds],[values[a:b] for a,b in bounds]
+        self.peak,self.column = np.full(n,-np.inf),np.zeros(n,dtype=np.int64)
+        nonempty = np.flatnonzero(np.diff(indptr))
+        if(len(nonempty)>0):
+            self.peak[nonempty] = np.maximum.reduceat(values,indptr[nonempty])
+            #the first present of each row at its largest probability, as argmax finds it
+            at_peak = np.flatnonzero(values==self.peak[entry_rows])
+            rows,first = np.unique(entry_rows[at_peak],return_index=True)
+            self.column[rows] = indices[at_peak[first]]
+        self.holders = [set() for column in range(width)]
+        for column,row in zip(indices.tolist(),entry_rows.tolist()):
+            self.holders[column].add(row)
+
+    def __len__(self):
+        return len(self.peak)
+
+    @classmethod
+    def from_probs(cls, probs):
+        """
+        Create the rows of a matrix of present state distributions (or StateTable)
+        """
+        return cls(*sparse_rows(probs),probs_width(probs))
+
+    def merge(self, row: int, partner: int):
+        """
+        Average the partner's distribution into the row's, as collapse_states merges states, retiring the partner
+        Returns what the row held before, for unmerge
+        """
+        columns = np.union1d(self.columns[row],self.columns[partner])
+        first,second = np.zeros(len(columns)),np.zeros(len(columns))
+        first[np.searchsorted(columns,self.columns[row])] = self.values[row]
+        second[np.searchsorted(columns,self.columns[partner])] = self.values[partner]
+        before = (self.columns[row],self.values[row],self.peak[row],self.column[row])
+        for column in self.columns[partner].tolist():
+            self.holders[column].discard(partner)
+        for column in columns.tolist():
+            self.holders[column].add(row)
+        self.columns[row],self.values[row] = columns,(first+second)/2
+        self.set_peak(row)
+        return before
+
+    def unmerge(self, row: int, partner: int, before):
+        """
+        Undo a merge, given what the row held before it
+        """
+        for column in self.columns[row].tolist():
+            self.holders[column].discard(row)
+        self.columns[row],self.values[row],self.peak[row],self.column[row] = before
+        for column in self.columns[row].tolist():
+            self.holders[column].add(row)
+        for column in self.columns[partner].tolist():
+            self.holders[column].add(partner)
+
+    def set_peak(self, row: int):
+        """
+        Find a row's largest probability and the (first) present it is found at
+        """
+        if(len(self.values[row])>0):
+            self.peak[row],self.column[row] = self.values[row].max(),self.columns[row][self.values[row].argmax()]
+        else:
+            self.peak[row],self.column[row] = -np.inf,0
+
+    def candidates(self, row: int, sigma: float, alive):
+        """
+        Find which other alive rows could differ from the given row by less than sigma (as in candidate_pairs)
+        """
+        if(self.peak[row]>=sigma):
+            #only the states with the row's largest present, at a probability within sigma of it
+            column = self.column[row]
+            others = np.fromiter(self.holders[column],dtype=np.int64,count=len(self.holders[column]))
+            values = np.array([self.values[other][np.searchsorted(self.columns[other],column)] for other in others.tolist()])
+            found = np.zeros(len(alive),dtype=bool)
+            found[others[np.abs(values-self.peak[row])<sigma]] = True
+            found &= alive
+        else:
+            dense = np.zeros(len(self.holders))
+            dense[self.columns[row]] = self.values[row]
+            found = alive & ((self.peak<sigma) | (np.abs(dense[self.column]-self.peak)<sigma))
+        found[row] = False
+        return np.flatnonzero(found)
+
+    def differences(self, row: int, others, block_elements: int = 1 << 16):
+        """
+        Calculate the difference (as in calculate_difference) between the given row and each of the other rows,
+        expanding them into a matrix when it holds at most block_elements values
+        """
+        if(len(others)*len(self.holders)<=block_elements):
+            indices,indptr,values = self.compressed(others)
+            matrix,dense = np.zeros([len(others),len(self.holders)]),np.zeros(len(self.holders))
+            matrix[np.repeat(np.arange(len(others)),np.diff(indptr)),indices] = values
+            dense[self.columns[row]] = self.values[row]
+            #only the presents either state has count (so two states without presents do not differ at all)
+            difference = np.where((matrix!=0) | (dense!=0),np.abs(matrix-dense),-np.inf)
+            return difference.max(axis=1,initial=-np.inf)
+        indices,indptr,values = self.compressed(np.concatenate([[row],others]).astype(np.int64))
+        return sparse_difference(indices,indptr,values,np.zeros(len(others),dtype=np.int64),np.arange(1,len(others)+1))
+
+    def compressed(self, rows):
+        """
+        Convert the given rows into compressed row form (column indices, row pointers, values)
+        """
+        rows = np.asarray(rows,dtype=np.int64).tolist()
+        indptr = np.concatenate([[0],np.cumsum([len(self.columns[row]) for row in rows],dtype=np.int64)])
+        if(len(rows)==0):
+            return np.zeros(0,dtype=np.int64),indptr,np.zeros(0)
+        return (np.concatenate([self.columns[row] for row in rows]),indptr,
+                np.concatenate([self.values[row] for row in rows]))
+
+def collapse_states(odict: dict, dl: int, sigma: float = 0.1, engine: str = "dict", previous=None):
     """
     Collapse a dictionary of state counts into practical states based on a permitted difference sigma
+    engine="numpy" finds the same merges in the same order with merge_sequence instead of restarting the search,
+    which is always used for a StateTable (and returns a StateTable)
+    previous (a collapsed StateTable, such as the previous window's) seeds the collapse of a StateTable, see warm_collapse
     """
+    if(_instrumentation is not None and "collapse_states" not in _instrumentation.running):
+        return _instrumentation.collapse(collapse_states,odict,dl,sigma,engine,previous)
+    if(isinstance(odict,StateTable) and previous is not None):
+        return warm_collapse(odict,sigma,previous)
+    if(isinstance(odict,StateTable) and _collapse_memo is not None):
+        return _collapse_memo.collapse(odict,sigma)
+    if(isinstance(odict,StateTable)):
+        merges,states,survivors = merge_sequence(odict,sigma)
+        return odict.merged(merges,states,survivors)
+    if(engine=="numpy"):
+        return collapse_states(StateTable.from_dict(odict,dl),dl,sigma).to_dict()
     # Newdict is the collapsed dictionary, temp is used to override newdict when necessary,
     # done_checker is a dictionary used to record the keys already compared
     newdict,temp,done_checker = deepcopy(odict),False,{}
@@ -145,6 +876,8 @@ def collapse_states(odict: dict, dl: int, sigma: float = 0.1):
                     else:
                         # If these states have already been checked, don't bother checking them again
                         continue
+                    if(_instrumentation is not None):
+                        _instrumentation.comparisons += 1
                     # If the difference is less than sigma, merge these states and break the past2 loop
                     if(calculate_difference(newdict[past1],newdict[past2])<sigma):
                         temp = merge_states(newdict,past1,past2,dl)
@@ -157,6 +890,119 @@ def collapse_states(odict: dict, dl: int, sigma: float = 0.1):
             break
     return newdict
 
+def warm_collapse(table, sigma: float, previous):
+    """
+    Collapse a table of raw states starting from the states of a previous collapsed table (such as the previous
+    window's): a previous state is kept whole if its pasts still merge one by one (in order of first occurrence, as
+    a state grows) and have drifted by less than sigma from its distribution, the others are split back into their
+    pasts, and only the pairs that could be closer than sigma are tested (see merge_sequence)
+    Kept states are merged in their own order, so the result can still differ from collapse_states, which is used
+    instead when it would test fewer pairs
+    """
+    n = len(table)
+    seeds = np.full(n,-1)
+    if(len(previous.members)>0):
+        order = np.argsort(previous.members)
+        owners = np.repeat(np.arange(len(previous)),np.diff(previous.member_ptr))[order]
+        position = np.minimum(np.searchsorted(previous.members[order],table.members),len(order)-1)
+        seeds = np.where(previous.members[order][position]==table.members,owners[position],-1)
+    #the collapse without a previous table tests every pair of a small table, or the candidate pairs of a large one,
+    #and is used instead whenever it tests fewer pairs (at least one per seeded state is tested here)
+    if(n*n*len(table.presents)<=1 << 22):
+        cold = n*(n-1)//2
+        if(np.count_nonzero(seeds>=0)>=cold):
+            return cold_collapse(table,sigma)
+    else:
+        cold = candidate_pairs(table.indices,table.indptr,table.probs,sigma)
+        if(np.count_nonzero(seeds>=0)>=len(cold[0])):
+            return cold_collapse(table,sigma,cold)
+    states = StateRows.from_probs(table)
+    #previous states with a single past left need only their drift tested
+    sizes = np.bincount(seeds[seeds>=0],minlength=len(previous))
+    single = np.flatnonzero((seeds>=0) & (sizes[np.maximum(seeds,0)]==1))
+    drift = np.full(n,np.inf)
+    drift[single] = previous_drift(states,single,table,previous,seeds[single])
+    merges,tests,groups = [],len(single),[]
+    rows = [np.flatnonzero(seeds<0),single]
+    grouped = np.flatnonzero((seeds>=0) & (sizes[np.maximum(seeds,0)]>1))
+    grouped = grouped[np.argsort(seeds[grouped],kind="stable")]
+    for members in np.split(grouped,np.flatnonzero(np.diff(seeds[grouped]))+1):
+        if(len(members)==0):
+            continue
+        first,undo = int(members[0]),[]
+        for member in members[1:].tolist():
+            tests += 1
+            if(states.differences(first,[member])[0]>=sigma):
+                break
+            undo.append((member,states.merge(first,member)))
+        groups.append((members,undo))
+    #the groups whose pasts all merged are kept if they have not drifted too far either
+    merged = [members[0] for members,undo in groups if len(undo)==len(members)-1]
+    tests += len(merged)
+    drift[merged] = previous_drift(states,merged,table,previous,seeds[merged])
+    for members,undo in groups:
+        if(drift[members[0]]<sigma):
+            merges += [(int(members[0]),int(member)) for member in members[1:]]
+            rows.append(members[:1])
+        else:
+            for member,before in reversed(undo):
+                states.unmerge(int(members[0]),member,before)
+            rows.append(members)
+    rows = np.sort(np.concatenate(rows))
+    seeded = table.merged(merges,states,rows)
+    # A kept state has drifted from its previous state by less than sigma, so two kept states can only have come
+    # closer than sigma if they were less than sigma plus both drifts apart before: only those pairs of kept states
+    # are tested again, with every candidate pair involving a split or new state
+    i,j = candidate_pairs(seeded.indices,seeded.indptr,seeded.probs,sigma)
+    kept = np.flatnonzero(drift[rows]<sigma)
+    owner = np.full(len(rows),-1)
+    owner[kept] = seeds[rows[kept]]
+    both = np.flatnonzero((owner[i]>=0) & (owner[j]>=0))
+    apart = sparse_difference(previous.indices,previous.indptr,previous.probs,owner[i[both]],owner[j[both]])
+    far = both[apart>=sigma+drift[rows[i[both]]]+drift[rows[j[both]]]]
+    tested = np.ones(len(i),dtype=bool)
+    tested[far] = False
+    i,j = i[tested],j[tested]
+    if(_instrumentation is not None):
+        _instrumentation.comparisons += tests
+    if(tests+len(i)>=(cold if isinstance(cold,int) else len(cold[0]))):
+        return cold_collapse(table,sigma,None if isinstance(cold,int) else cold)
+    if(_instrumentation is not None):
+        _instrumentation.comparisons += len(i)
+    close = sparse_difference(seeded.indices,seeded.indptr,seeded.probs,i,j)<sigma
+    sequence,states,survivors = merge_sequence(seeded,sigma,(i[close],j[close]))
+    return seeded.merged(sequence,states,survivors)
+
+def cold_collapse(table, sigma: float, pairs=None):
+    """
+    Collapse a table of raw states as collapse_states does, given its candidate_pairs if they are already found
+    """
+    if(pairs is None):
+        merges,states,survivors = merge_sequence(table,sigma)
+    else:
+        i,j = pairs
+        if(_instrumentation is not None):
+            _instrumentation.comparisons += len(i)
+        close = sparse_difference(table.indices,table.indptr,table.probs,i,j)<sigma
+        merges,states,survivors = merge_sequence(table,sigma,(i[close],j[close]))
+    return table.merged(merges,states,survivors)
+
+def previous_drift(states, rows, table, previous, owners):
+    """
+    Calculate the difference (as in calculate_difference) between the given rows of a table's states (a StateRows)
+    and the given states (owners) of a previous table, over the presents of both
+    """
+    presents = np.union1d(table.presents,previous.presents)
+    indices,indptr,values = states.compressed(rows)
+    owners = np.asarray(owners,dtype=np.int64)
+    positions = range_positions(previous.indptr[owners],np.diff(previous.indptr)[owners])[0]
+    previous_ptr = np.concatenate([[0],np.cumsum(np.diff(previous.indptr)[owners])])
+    indices = np.concatenate([np.searchsorted(presents,table.presents[indices]),
+                              np.searchsorted(presents,previous.presents[previous.indices[positions]])])
+    indptr = np.concatenate([indptr,indptr[-1]+previous_ptr[1:]])
+    values = np.concatenate([values,previous.probs[positions]])
+    return sparse_difference(indices,indptr,values,np.arange(len(owners)),len(owners)+np.arange(len(owners)))
+
 def calculate_difference(past1: dict, past2: dict):
     """
     Calculate the difference between two past states' present state distributions
@@ -177,10 +1023,170 @@ def calculate_difference(past1: dict, past2: dict):
                 difference = max(difference,past2[present])
     return difference
 
+def state_peaks(probs):
+    """
+    Find which presents each state has and its largest present probability (-inf for states without presents)
+    """
+    support = (probs!=0).astype(np.float32)
+    return support,np.where(support.any(axis=1),probs.max(axis=1,initial=-np.inf),-np.inf)
+
+def probs_width(probs):
+    """
+    Find the number of presents of a matrix of present state distributions (or StateTable)
+    """
+    return len(probs.presents) if isinstance(probs,StateTable) else np.shape(probs)[1]
+
+def sparse_rows(probs):
+    """
+    Convert a matrix of present state distributions (or StateTable) into compressed row form
+    (column indices, row pointers, values)
+    """
+    if(isinstance(probs,StateTable)):
+        return probs.indices,probs.indptr,probs.probs
+    rows,columns = np.nonzero(probs)
+    return columns,np.concatenate([[0],np.cumsum(np.bincount(rows,minlength=len(probs)))]),probs[rows,columns]
+
+def range_positions(starts, lengths):
+    """
+    Find every position in the ranges [start, start+length) one after another, and which range each belongs to
+    """
+    owners = np.repeat(np.arange(len(starts)),lengths)
+    return np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths-starts,lengths),owners
+
+def candidate_pairs(indices, indptr, values, sigma: float):
+    """
+    Find the pairs of rows (i < j) of a matrix of present state distributions in compressed row form that could
+    differ by less than sigma, without comparing every pair
+    """
+    # Two states closer than sigma are closer than sigma at the present where either has its largest probability p,
+    # so when p >= sigma the other state has that present too, with a probability within sigma of p: each such state
+    # is only paired with the states found around p in the sorted probabilities of its largest present. States below
+    # sigma everywhere are paired with each other
+    n = len(indptr)-1
+    entry_rows = np.repeat(np.arange(n),np.diff(indptr))
+    peak,column = np.full(n,-np.inf),np.zeros(n,dtype=np.int64)
+    if(len(values)>0):
+        #the last entry of each row, sorted by probability, is its largest
+        by_value = np.lexsort((values,entry_rows))
+        nonempty = np.flatnonzero(np.diff(indptr))
+        peak[nonempty],column[nonempty] = values[by_value[indptr[nonempty+1]-1]],indices[by_value[indptr[nonempty+1]-1]]
+    # every present's probabilities in order, as keys 4 apart per present (widened by their rounding error)
+    keys = indices*4.+values
+    error = 4*np.spacing(4.*(indices.max(initial=0)+1))
+    by_key = np.argsort(keys,kind="stable")
+    query = np.flatnonzero(peak>=sigma)
+    centres = column[query]*4.+peak[query]
+    low = np.searchsorted(keys[by_key],centres-sigma-error,"left")
+    high = np.searchsorted(keys[by_key],centres+sigma+error,"right")
+    positions,owners = range_positions(low,high-low)
+    i,j = query[owners],entry_rows[by_key[positions]]
+    spread = np.flatnonzero(peak<sigma)
+    a,b = np.triu_indices(len(spread),1)
+    i,j = np.concatenate([i,spread[a]]),np.concatenate([j,spread[b]])
+    pairs = np.unique(np.minimum(i,j)[i!=j]*n+np.maximum(i,j)[i!=j])
+    return pairs//max(n,1),pairs%max(n,1)
+
+def sparse_difference(indices, indptr, values, i, j):
+    """
+    Calculate the difference (as in calculate_difference) between rows i[k] and j[k] of a matrix of present state
+    distributions in compressed row form, for every k
+    """
+    first,first_pairs = range_positions(indptr[i],indptr[i+1]-indptr[i])
+    second,second_pairs = range_positions(indptr[j],indptr[j+1]-indptr[j])
+    #the entries of both rows, the second negated, so that the two entries of a shared present sum to their difference
+    width = indices.max(initial=0)+1
+    keys = np.concatenate([first_pairs*width+indices[first],second_pairs*width+indices[second]])
+    entries = np.concatenate([values[first],-values[second]])
+    order = np.argsort(keys,kind="stable")
+    keys,entries = keys[order],entries[order]
+    starts = np.flatnonzero(np.concatenate([[True],keys[1:]!=keys[:-1]])) if len(keys)>0 else np.zeros(0,dtype=np.int64)
+    differences,pairs = np.abs(np.add.reduceat(entries,starts)),keys[starts]//width
+    difference = np.full(len(i),-np.inf)
+    if(len(starts)>0):
+        pair_starts = np.flatnonzero(np.concatenate([[True],pairs[1:]!=pairs[:-1]]))
+        difference[pairs[pair_starts]] = np.maximum.reduceat(differences,pair_starts)
+    return difference
+
+def difference_block(probs, support, peak, others, other_support, other_peak, sigma: float = None):
+    """
+    Calculate the differences between rows of probs and rows of others, given the outputs of state_peaks for both
+    """
+    # Two distributions differ by at most the larger of their largest probabilities, and by exactly that when they
+    # share no presents, so only pairs sharing a present are compared present by present
+    difference = np.maximum(peak[:,None],other_peak[None,:])
+    i,j = np.nonzero(support @ other_support.T)
+    if(sigma is not None):
+        # pairs already closer than sigma at their bound need no closer look
+        shared = difference[i,j]>=sigma
+        i,j = i[shared],j[shared]
+    difference[i,j] = np.abs(probs[i]-others[j]).max(axis=1)
+    return difference
+
+def pairwise_difference(probs, others=None, sigma: float = None, block_elements: int = 1 << 22):
+    """
+    Calculate the difference (as in calculate_difference) between every pair of rows in a matrix of present state
+    distributions, or between its rows and the rows of others, in blocks of at most block_elements values
+    With sigma, only the pairs closer than sigma are returned, as arrays of row numbers (i < j when others is None),
+    testing only the candidate_pairs of a matrix compared with itself when it does not fit in a single block
+    """
+    if(sigma is not None and others is None and len(probs)**2*probs_width(probs)>block_elements):
+        indices,indptr,values = sparse_rows(probs if isinstance(probs,StateTable) else np.asarray(probs,dtype=float))
+        i,j = candidate_pairs(indices,indptr,values,sigma)
+        if(_instrumentation is not None):
+            _instrumentation.comparisons += len(i)
+        close = sparse_difference(indices,indptr,values,i,j)<sigma
+        return i[close],j[close]
+    if(isinstance(probs,StateTable)):
+        probs = probs.dense()
+    probs = np.asarray(probs,dtype=float)
+    others = probs if others is None else np.asarray(others,dtype=float)
+    symmetric = others is probs
+    n,m = len(probs),len(others)
+    block = max(1,int(np.sqrt(block_elements/max(probs.shape[1],1))))
+    support,peak = state_peaks(probs)
+    other_support,other_peak = (support,peak) if symmetric else state_peaks(others)
+    output = np.empty([n,m]) if sigma is None else None
+    pairs_i,pairs_j = [],[]
+    for start in range(0,n,block):
+        rows = slice(start,min(start+block,n))
+        # only the upper triangle is needed when comparing a matrix with itself
+        for other_start in range(start if symmetric else 0,m,block):
+            cols = slice(other_start,min(other_start+block,m))
+            difference = difference_block(probs[rows],support[rows],peak[rows],
+                                          others[cols],other_support[cols],other_peak[cols],sigma)
+            if(sigma is None):
+                output[rows,cols] = difference
+                if(symmetric):
+                    output[cols,rows] = difference.T
+            else:
+                i,j = np.nonzero(difference<sigma)
+                i,j = i+start,j+other_start
+                if(symmetric):
+                    i,j = i[i<j],j[i<j]
+                pairs_i.append(i)
+                pairs_j.append(j)
+    if(sigma is None):
+        if(symmetric):
+            np.fill_diagonal(output,0.)
+        return output
+    if(not pairs_i):
+        pairs_i,pairs_j = [np.zeros(0,dtype=np.int64)],[np.zeros(0,dtype=np.int64)]
+    i,j = np.concatenate(pairs_i),np.concatenate(pairs_j)
+    tested = n*(n-1)//2 if symmetric else n*m
+    if(_instrumentation is not None):
+        _instrumentation.comparisons += tested
+    return i,j
+
 def merge_states(odict: dict, past1: dict, past2: dict, dl: int):
     """
     Merge 2 states and their present state distributions, creating a new state key in a standardised manner
+    For a StateTable, past1 and past2 are the row numbers of the two states
     """
+    if(isinstance(odict,StateTable)):
+        states = StateRows.from_probs(odict)
+        states.merge(past1,past2)
+        rows = [row for row in range(len(odict)) if row!=past1 and row!=past2]+[past1]
+        return odict.merged([(past1,past2)],states,rows)
     nprobs = {}
     for present in odict[past1]:
         if(present in odict[past2]):
@@ -191,6 +1197,18 @@ def merge_states(odict: dict, past1: dict, past2: dict, dl: int):
         if(present not in odict[past1]):
             nprobs.update({present:odict[past2][present]/2})
     nprobs.update({"total":odict[past1]["total"]+odict[past2]["total"]})
+    newkey = merge_keys(past1,past2,dl)
+    #add the new key and remove the old ones
+    ndict = deepcopy(odict)
+    ndict.update({newkey:nprobs})
+    del ndict[past1]
+    del ndict[past2]
+    return ndict
+
+def merge_keys(past1: str, past2: str, dl: int):
+    """
+    Create the standardised key of two merged states: their pasts sorted and joined together
+    """
     #create a sorted version of the two pasts combined
     temp,to_sort = past1+past2,[]
     for i in range(int(len(temp)/dl)):
@@ -198,18 +1216,151 @@ def merge_states(odict: dict, past1: dict, past2: dict, dl: int):
     newkey = ""
     while(len(to_sort)>0):
         newkey += to_sort.pop(to_sort.index(min(to_sort)))
-    #add the new key and remove the old ones
-    ndict = deepcopy(odict)
-    ndict.update({newkey:nprobs})
-    del ndict[past1]
-    del ndict[past2]
-    return ndict
+    return newkey
+
+def merge_sequence(probs, sigma: float = 0.1, close=None):
+    """
+    Find the merges collapse_states makes on a matrix of present state distributions (one row per state, in order)
+    or StateTable, returning the merges as (row, partner) pairs, the merged distributions (a StateRows) and the
+    surviving rows in state order
+    close gives the pairs of rows (as arrays i, j) closer than sigma to start from, found by the caller, instead of
+    testing every pair
+    """
+    # Reference order: the earliest state with any partner closer than sigma merges with its earliest such partner,
+    # and the merged state moves to the end. Pairs that were too far apart never need testing again, so only the
+    # pairs involving the newly merged state (kept in the first state's row) are tested after each merge. The close
+    # pairs are kept as a set of partners per state, so memory grows with the states and their close pairs
+    states = StateRows.from_probs(probs)
+    n = len(states)
+    alive,order = np.ones(n,dtype=bool),np.arange(n)
+    i,j = pairwise_difference(probs,sigma=sigma) if close is None else close
+    close = [set() for row in range(n)]
+    for a,b in zip(np.asarray(i).tolist(),np.asarray(j).tolist()):
+        close[a].add(b)
+        close[b].add(a)
+    degree,merges = np.array([len(partners) for partners in close],dtype=np.int64),[]
+    while(degree.any()):
+        rows = np.flatnonzero(degree)
+        row = int(rows[np.argmin(order[rows])])
+        partner = min(close[row],key=lambda other: order[other])
+        merges.append((row,partner))
+        #average the two distributions in place and retire the partner
+        states.merge(row,partner)
+        alive[partner],order[row] = False,n+len(merges)
+        for old in (row,partner):
+            for other in close[old]:
+                close[other].discard(old)
+                degree[other] -= 1
+            close[old],degree[old] = set(),0
+        #only pairs with the merged state need testing, and only its candidates could be close
+        candidates = states.candidates(row,sigma,alive)
+        if(_instrumentation is not None):
+            _instrumentation.comparisons += len(candidates)
+        new_close = candidates[states.differences(row,candidates)<sigma].tolist()
+        for other in new_close:
+            close[other].add(row)
+        close[row] = set(new_close)
+        degree[new_close] += 1
+        degree[row] = len(new_close)
+    survivors = np.flatnonzero(alive)
+    return merges,states,survivors[np.argsort(order[survivors])]
+
+def merge_sweep(probs, sigmas):
+    """
+    Find the merges merge_sequence makes on a matrix of present state distributions (or StateTable) for every sigma
+    in sigmas, reusing the merges made for a smaller sigma wherever a larger sigma would make them too
+    Returns one (merges, surviving rows) pair per sigma, in the order of sigmas
+    """
+    # Working up through the sigmas, a merge made at sigma is made again at a larger sigma while no state before it
+    # (and no partner before the chosen one) comes closer than that sigma, so each merge records the smallest such
+    # distance (its gap), and only the merges after the first gap below the next sigma are undone and searched again
+    states = StateRows.from_probs(probs)
+    n = len(states)
+    alive,order = np.ones(n,dtype=bool),np.arange(n)
+    top = max(sigmas,default=0.)
+    #no sigma merges pairs at least the largest sigma apart, so only the distances of closer pairs are kept
+    #(as a dictionary of distances per state)
+    indices,indptr,values = sparse_rows(probs if isinstance(probs,StateTable) else np.asarray(probs,dtype=float))
+    i,j = candidate_pairs(indices,indptr,values,top)
+    if(_instrumentation is not None):
+        _instrumentation.comparisons += len(i)
+    difference = sparse_difference(indices,indptr,values,i,j)
+    distance = [{} for row in range(n)]
+    for a,b,d in zip(i.tolist(),j.tolist(),difference.tolist()):
+        if(d<top):
+            distance[a][b],distance[b][a] = d,d
+    nearest = np.array([min(row.values(),default=np.inf) for row in distance])
+    merges,gaps,undo,fixed,results = [],[],[],0,{}
+    for sigma in sorted(set(sigmas)):
+        kept = np.flatnonzero(np.minimum.accumulate(gaps)<sigma) if gaps else []
+        kept = kept[0] if len(kept)>0 else len(merges)
+        while(len(merges)>kept):
+            (row,partner),gap = merges.pop(),gaps.pop()
+            before,old_order,old_row,old_partner,changed,old_nearest = undo.pop()
+            states.unmerge(row,partner,before)
+            order[row],alive[partner] = old_order,True
+            for other in distance[row]:
+                del distance[other][row]
+            distance[row],distance[partner] = old_row,old_partner
+            for other,d in old_row.items():
+                distance[other][row] = d
+            for other,d in old_partner.items():
+                distance[other][partner] = d
+            nearest[changed] = old_nearest
+        while(True):
+            rows = np.flatnonzero(nearest<sigma)
+            if(len(rows)==0):
+                break
+            row = int(rows[np.argmin(order[rows])])
+            partner = min((other for other,d in distance[row].items() if d<sigma),key=lambda other: order[other])
+            gap = min(nearest[order<order[row]].min(initial=np.inf),
+                      min((d for other,d in distance[row].items() if order[other]<order[partner]),default=np.inf))
+            old_row,old_partner = distance[row],distance[partner]
+            #average the two distributions in place and retire the partner
+            old_order = order[row]
+            before = states.merge(row,partner)
+            alive[partner],order[row] = False,n+len(merges)+1
+            candidates = states.candidates(row,top,alive)
+            if(_instrumentation is not None):
+                _instrumentation.comparisons += len(candidates)
+            new = {other:d for other,d in zip(candidates.tolist(),states.differences(row,candidates).tolist()) if d<top}
+            for other in old_row:
+                if(other!=partner):
+                    del distance[other][row]
+            for other in old_partner:
+                if(other!=row):
+                    del distance[other][partner]
+            distance[row],distance[partner] = new,{}
+            for other,d in new.items():
+                distance[other][row] = d
+            #only the states whose nearest state was one of the pair need searching again
+            stale = {other for old in (old_row,old_partner) for other,d in old.items() if d==nearest[other]}
+            updated = nearest.copy()
+            for other,d in new.items():
+                updated[other] = min(updated[other],d)
+            for other in stale | {row,partner}:
+                updated[other] = min(distance[other].values(),default=np.inf)
+            changed = np.flatnonzero(updated!=nearest)
+            if(len(merges)==fixed and gap>=top):
+                #no larger sigma can undo this merge, so nothing is kept to undo it
+                fixed += 1
+                undo.append(None)
+            else:
+                undo.append((before,old_order,old_row,old_partner,changed,nearest[changed]))
+            nearest = updated
+            merges.append((row,partner))
+            gaps.append(gap)
+        survivors = np.flatnonzero(alive)
+        results[sigma] = (list(merges),survivors[np.argsort(order[survivors])])
+    return [results[sigma] for sigma in sigmas]
 
 #collapse dictionary of past states and future states into an array of probabilities of the past states
 def collapse_past(odict):
     """
     Collapse a dictionary of past states with present state distribtuions into an array of probabilities of the past states
     """
+    if(isinstance(odict,StateTable)):
+        return odict.totals.astype(float)/odict.totals.sum()
     probs,i,total = np.zeros(len(odict),dtype=float),0,0
     for past in odict:
         probs[i] += odict[past]["total"]
@@ -223,6 +1374,8 @@ def collapse_keys(d1: dict, d2: dict):
     Note: keys present in both dictionaries lose their probability distributions and only the "total" key remains,
           but this is all that is needed by the point they are merged
     """
+    if(isinstance(d1,StateTable)):
+        return collapse_tables(d1,d2)
     ndict = {}
     for key in d1:
         # as longer keys are created and sorted in a standard way, they are all standardised
@@ -239,6 +1392,33 @@ def collapse_keys(d1: dict, d2: dict):
             ndict.update({key:d2[key]})
     return ndict
 
+def collapse_tables(t1: StateTable, t2: StateTable):
+    """
+    Merge 2 tables of states in the same way as collapse_keys: states with the same pasts keep only their total count
+    """
+    presents = np.union1d(t1.presents,t2.presents)
+    rows2 = {tuple(members.tolist()):i for i,members in enumerate(t2.member_lists())}
+    used,rows = set(),[]
+    for i,members in enumerate(t1.member_lists()):
+        key = tuple(members.tolist())
+        if(key in rows2):
+            used.add(rows2[key])
+            rows.append((members,[],[],t1.totals[i]+t2.totals[rows2[key]]))
+        else:
+            entries = slice(t1.indptr[i],t1.indptr[i+1])
+            rows.append((members,t1.presents[t1.indices[entries]],t1.probs[entries],t1.totals[i]))
+    for i,members in enumerate(t2.member_lists()):
+        if(i not in used):
+            entries = slice(t2.indptr[i],t2.indptr[i+1])
+            rows.append((members,t2.presents[t2.indices[entries]],t2.probs[entries],t2.totals[i]))
+    member_ptr = np.cumsum([0]+[len(row[0]) for row in rows])
+    indptr = np.cumsum([0]+[len(row[1]) for row in rows])
+    members = np.concatenate([row[0] for row in rows]) if rows else []
+    codes = np.concatenate([np.asarray(row[1],dtype=np.int64) for row in rows]) if rows else np.zeros(0,dtype=np.int64)
+    probs = np.concatenate([np.asarray(row[2],dtype=float) for row in rows]) if rows else []
+    return StateTable(t1.dl,members,member_ptr,presents,np.searchsorted(presents,codes),indptr,probs,
+                      [row[3] for row in rows])
+
 def probs_to_complexity(probs):
     """
     Calculate the Statistical Complexity given an array of past state probabilities
@@ -262,36 +1442,421 @@ def binarise(data,mode="median"):
         data=np.array(data,dtype=float)
     if(isinstance(data,np.ndarray)==False):
         return "Unusable datatype {}".format(type(data))
+    # Convert to string
+    return bits_to_string(binarise_bits(data,mode))
+
+def binarise_bits(data,mode="median",axis=-1,packed=False):
+    """
+    Binarise continuous numbers along an axis (one threshold per row of a matrix) into a uint8 array of 0's and 1's
+    packed=True returns a BitSequence for 1D data (a list of them, one per row, for a matrix)
+    """
+    if(_instrumentation is not None and "binarise" not in _instrumentation.running):
+        return _instrumentation.timed("binarise",binarise_bits,data,mode,axis,packed)
+    data = np.asarray(data,dtype=float)
     if(mode=="median"):
-        threshold=np.median(data)
+        threshold=np.median(data,axis=axis,keepdims=True)
     elif(mode=="mean"):
-        threshold=np.mean(data)
-    output = np.zeros([len(data)],dtype=int)
-    for i in range(len(data)):
-        if(data[i]>=threshold):
-            output[i]+=1
-    # Convert to string
-    outstr = ""
-    for element in output:
-        outstr += str(element)
-    return outstr
+        threshold=np.mean(data,axis=axis,keepdims=True)
+    else:
+        raise ValueError("Unknown binarisation mode {}".format(mode))
+    bits = (data>=threshold).astype(np.uint8)
+    if(packed):
+        return BitSequence(bits) if bits.ndim==1 else [BitSequence(row) for row in np.moveaxis(bits,axis,-1).reshape(-1,bits.shape[axis])]
+    return bits
+
+def bits_to_string(bits):
+    """
+    View a 1D array of 0's and 1's as a string of 0's and 1's
+    """
+    return (np.asarray(bits,dtype=np.uint8)+ord("0")).tobytes().decode("ascii")
 
-def multi_binarise(matrix,mode="median"):
+def multi_binarise(matrix,mode="median",as_bits=False):
     """
-    Binarise a 2D matrix (used for calculating multiple statistical complexities)    
+    Binarise a 2D matrix (used for calculating multiple statistical complexities)
+    as_bits=True returns a uint8 matrix of bits rather than an array of strings
     """
     print("Binarising data...")
     # Convert to numpy matrix
     if(type(matrix)==list or type(matrix)==tuple):
         matrix=np.array(matrix,dtype=object)
-    output = []
-    percent_check = 0.
-    for i in range(len(matrix)):
-        output.append(binarise(matrix[i],mode))
-        # Output progress
-        if((i+1)/float(len(matrix))>=percent_check/100.):
-            print("{}% of data binarised".format(\
-                round(((i+1)/len(matrix))*100,1)))
-            percent_check+=10.
+    try:
+        bits = binarise_bits(np.asarray(matrix,dtype=float),mode,axis=1)
+    except ValueError:
+        #rows of different lengths are binarised one at a time
+        bits = [binarise_bits(row,mode) for row in matrix]
     print("Data Binarised")
-    return np.array(output, dtype = object)
\ No newline at end of file
+    if(as_bits):
+        return bits
+    return np.array([bits_to_string(row) for row in bits], dtype = object)
+
+def stream_windows(file_path: str, columns, window: int, step: int, chunksize: int = 1 << 16):
+    """
+    Read the given columns of a CSV file in chunks of chunksize rows, yielding (start, window x columns array) for every
+    window of window samples starting every step samples, so only about one window and one chunk are ever held
+    The file's binary store (see convert_voltages) is read instead when it is up to date
+    """
+    voltages = open_voltages(file_path,columns)
+    if(voltages is not None):
+        #a binary store is read window by window straight from its memory maps
+        for start in range(0,len(voltages[columns[0]])-window+1,step):
+            yield start,np.stack([voltages[column][start:start+window] for column in columns],axis=1).astype(float)
+        return
+    import pandas as pd
+    #buffer holds the samples from offset onwards that a later window still needs
+    buffer,offset,start = np.zeros([0,len(columns)]),0,0
+    reader = iter(pd.read_csv(file_path,usecols=columns,chunksize=chunksize))
+    while(True):
+        with stage_timer("read_csv"):
+            chunk = next(reader,None)
+        if(chunk is None):
+            break
+        buffer = np.concatenate([buffer,chunk[columns].to_numpy(dtype=float)])
+        while(start+window<=offset+len(buffer)):
+            yield start,buffer[start-offset:start-offset+window]
+            start += step
+        drop = min(start-offset,len(buffer))
+        buffer,offset = buffer[drop:],offset+drop
+
+def voltage_store(file_path: str):
+    """
+    Find the folder of the binary store of a CSV file of voltages (next to the CSV file)
+    """
+    return file_path[:-len(".csv")]+"_voltages" if file_path.endswith(".csv") else file_path+"_voltages"
+
+def convert_voltages(file_path: str, columns=None, sample_rate: int = None, dtype: str = "float64",
+                                      chunksize: int = 1 << 16):
+    """
+    Convert the columns of a CSV file of voltages (all of its numeric columns by default, judged by the first chunk)
+    into a binary store: one .npy file per channel and a meta.json holding the channels, sample rate, length and dtype,
+    reading the CSV in chunks. A conversion that fails leaves no channels behind
+    dtype="float32" halves the store, at the cost of the values no longer matching the CSV exactly
+    """
+    import os,json
+    import pandas as pd
+    if(columns is None):
+        columns = list(pd.read_csv(file_path,nrows=chunksize).select_dtypes("number").columns)
+        if(not columns):
+            raise ValueError("{} has no numeric columns to convert".format(file_path))
+    with open(file_path) as f:
+        length = sum(1 for line in f)-1
+    store = voltage_store(file_path)
+    created = not os.path.isdir(store)
+    os.makedirs(store,exist_ok=True)
+    #an out of date meta.json must not outlive the channels being rewritten
+    if(os.path.exists(os.path.join(store,"meta.json"))):
+        os.remove(os.path.join(store,"meta.json"))
+    paths = [os.path.join(store,"{}.npy".format(i)) for i in range(len(columns))]
+    start = 0
+    try:
+        channels = [np.lib.format.open_memmap(path,mode="w+",dtype=dtype,shape=(length,)) for path in paths]
+        for chunk in pd.read_csv(file_path,usecols=columns,chunksize=chunksize):
+            for i,column in enumerate(columns):
+                channels[i][start:start+len(chunk)] = chunk[column].to_numpy(dtype=float)
+            start += len(chunk)
+        for channel in channels:
+            channel.flush()
+        del channels
+    except BaseException:
+        #the memory maps are closed before their files are removed
+        channels = None
+        for path in paths:
+            if(os.path.exists(path)):
+                os.remove(path)
+        if(created and not os.listdir(store)):
+            os.rmdir(store)
+        raise
+    #the metadata is written last, so a store is only used once it is complete
+    with open(os.path.join(store,"meta.json"),"w") as f:
+        json.dump({"channels":columns,"sample_rate":sample_rate,"length":start,"dtype":dtype},f)
+    return store
+
+def open_voltages(file_path: str, columns):
+    """
+    Open the given channels of the binary store of a CSV file of voltages as read-only memory maps
+    Returns a dictionary of arrays by channel, or None if there is no store newer than the CSV file with every channel
+    """
+    import os,json
+    meta_path = os.path.join(voltage_store(file_path),"meta.json")
+    if(not os.path.exists(meta_path)):
+        return None
+    if(os.path.exists(file_path) and os.path.getmtime(meta_path)<os.path.getmtime(file_path)):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if(any(column not in meta["channels"] for column in columns)):
+        return None
+    #blank lines at the end of the CSV leave unused samples at the end of each channel
+    return {column:np.load(os.path.join(voltage_store(file_path),"{}.npy".format(meta["channels"].index(column))),
+                           mmap_mode="r")[:meta["length"]] for column in columns}
+
+class ResultCache:
+    """
+    An on-disk (sqlite) cache of results keyed by a hash of the input data and the parameters used, keeping at most
+    max_entries results (evicting the least recently used) and dropping any results of another ALGORITHM_VERSION
+    Results are only counted when this connection's own count of them (from opening the cache, plus every result
+    it stores) passes max_entries, and are then evicted down to 15/16 of max_entries, so most stores count nothing
+    """
+    def __init__(self, path: str, max_entries: int = 1 << 22):
+        import sqlite3
+        self.path,self.max_entries = path,max_entries
+        #several processes may share the cache, so writers wait for each other rather than failing
+        self.connection = sqlite3.connect(path,timeout=60)
+        self.use_wal(60)
+        with self.connection:
+            self.connection.execute("create table if not exists results "
+                                    "(key text primary key, version integer, value real, used real)")
+            self.connection.execute("create index if not exists results_used on results (used)")
+            self.connection.execute("delete from results where version!=?",(ALGORITHM_VERSION,))
+        self.rows = self.connection.execute("select count(*) from results").fetchone()[0]
+
+    def use_wal(self, timeout: float):
+        """
+        Switch the cache to write-ahead logging, so readers and a writer don't block each other
+        The busy timeout doesn't cover the switch, so another process opening a new cache at the same time is waited
+        for here, and a cache already switched (the setting is kept in the file) is left alone
+        """
+        import sqlite3,time
+        deadline = time.monotonic()+timeout
+        while(True):
+            try:
+                if(self.connection.execute("pragma journal_mode").fetchone()[0]!="wal"):
+                    self.connection.execute("pragma journal_mode=wal")
+                return
+            except sqlite3.OperationalError:
+                if(time.monotonic()>deadline):
+                    raise
+                time.sleep(0.05)
+
+    def key(self, data, *params):
+        """
+        Create the key of a result from its input data (an array of numbers) and any parameters (with repr)
+        """
+        import hashlib
+        digest = hashlib.blake2b(np.ascontiguousarray(data,dtype=float).tobytes(),digest_size=16)
+        digest.update(repr((ALGORITHM_VERSION,)+params).encode())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        """
+        Find the cached result of each key, or None for keys without one
+        """
+        import time
+        found = {}
+        for start in range(0,len(keys),500):
+            chunk = list(keys[start:start+500])
+            marks = ",".join("?"*len(chunk))
+            #results are stored as NULL for NaN, as sqlite stores NaN
+            found.update((key,np.nan if value is None else value) for key,value in
+                         self.connection.execute("select key,value from results where key in ({})".format(marks),chunk))
+            with self.connection:
+                self.connection.execute("update results set used=? where key in ({})".format(marks),[time.time()]+chunk)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, keys, values):
+        """
+        Store a result for each key, evicting the least recently used results once there may be more than max_entries
+        """
+        import time
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("insert or replace into results values (?,?,?,?)",
+                                        [(key,ALGORITHM_VERSION,None if np.isnan(value) else float(value),now)
+                                         for key,value in zip(keys,values)])
+            #replaced results are counted too, so the count only ever overestimates
+            self.rows += len(keys)
+            if(self.rows>self.max_entries):
+                self.rows = self.connection.execute("select count(*) from results").fetchone()[0]
+                if(self.rows>self.max_entries):
+                    excess = self.rows-(self.max_entries-self.max_entries//16)
+                    self.connection.execute("delete from results where key in "
+                                            "(select key from results order by used limit ?)",(excess,))
+                    self.rows -= excess
+
+    def get(self, key):
+        """
+        Find the cached result of a key, or None
+        """
+        return self.get_many([key])[0]
+
+    def put(self, key, value):
+        """
+        Store the result of a key
+        """
+        self.put_many([key],[value])
+
+    def close(self):
+        self.connection.close()
+
+class CollapseMemo:
+    """
+    An in-memory memo of the merges made collapsing StateTables, keyed by a hash of the tables' present state
+    distributions (quantised to multiples of quantum, if given) with lambda and sigma, holding at most max_bytes of
+    merges (evicting the least recently used). Merges only depend on the distributions, so a table found in the memo
+    is collapsed by repeating its merges, without testing any pairs
+    """
+    def __init__(self, max_bytes: int = 1 << 28, quantum: float = None):
+        from collections import OrderedDict
+        self.max_bytes,self.quantum = max_bytes,quantum
+        self.entries,self.bytes,self.hits,self.misses = OrderedDict(),0,0,0
+
+    def key(self, table, sigma: float):
+        """
+        Create the key of a table's collapse from its distributions (and the number of its states and presents)
+        """
+        import hashlib
+        #the entries of each state in order of present, however the table was built
+        rows = np.repeat(np.arange(len(table)),np.diff(table.indptr))
+        order = np.argsort(rows*len(table.presents)+table.indices,kind="stable")
+        probs = table.probs[order] if self.quantum is None else np.round(table.probs[order]/self.quantum).astype(np.int64)
+        digest = hashlib.blake2b(repr((len(table),len(table.presents),table.dl,float(sigma))).encode(),digest_size=16)
+        for array in (table.indptr,table.indices[order],probs):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.digest()
+
+    def collapse(self, table, sigma: float):
+        """
+        Collapse a table as collapse_states does, repeating the merges of the same table if it is in the memo
+        """
+        key = self.key(table,sigma)
+        found = self.entries.get(key)
+        if(found is None):
+            self.misses += 1
+            merges,states,survivors = merge_sequence(table,sigma)
+            found = (np.array(merges,dtype=np.int64).reshape(-1,2),survivors)
+            self.entries[key] = found
+            self.bytes += found[0].nbytes+found[1].nbytes+len(key)
+            while(self.bytes>self.max_bytes and self.entries):
+                old_key,(old_merges,old_survivors) = self.entries.popitem(last=False)
+                self.bytes -= old_merges.nbytes+old_survivors.nbytes+len(old_key)
+            return table.merged(merges,states,survivors)
+        self.hits += 1
+        self.entries.move_to_end(key)
+        merges,survivors = found
+        states = StateRows.from_probs(table)
+        for row,partner in merges.tolist():
+            states.merge(row,partner)
+        return table.merged(merges,states,survivors)
+
+    def report(self):
+        """
+        Summarise the memo's use as a dictionary (ready for json)
+        """
+        return {"hits":self.hits,"misses":self.misses,"entries":len(self.entries),"bytes":self.bytes}
+
+_collapse_memo = None
+
+def start_collapse_memo(max_bytes: int = 1 << 28, quantum: float = None):
+    """
+    Start memoising the collapses of StateTables (see CollapseMemo), returning the CollapseMemo doing so
+    quantum > 0 lets tables with almost the same distributions share their merges, giving approximate results
+    """
+    global _collapse_memo
+    _collapse_memo = CollapseMemo(max_bytes,quantum)
+    return _collapse_memo
+
+def stop_collapse_memo():
+    """
+    Stop memoising collapses, returning the report of the memo's use (or None if it was not started)
+    """
+    global _collapse_memo
+    report = _collapse_memo.report() if _collapse_memo is not None else None
+    _collapse_memo = None
+    return report
+
+class Instrumentation:
+    """
+    A record of the wall time spent in each stage (binarise, find_states, collapse_states, complexity and any stages
+    timed by the driver scripts) and of the counts of each collapse: raw states, refined states, merges and pair
+    comparisons. Nothing is recorded unless instrumentation is started (see start_instrumentation)
+    """
+    def __init__(self, callback=None, keep_collapses: bool = True):
+        self.seconds,self.calls,self.totals,self.collapses = {},{},{},[]
+        #stages being timed, so stages calling themselves (or each other by the same name) are only timed once
+        self.running = set()
+        #pair comparisons made by the collapse in progress
+        self.comparisons = 0
+        self.callback,self.keep_collapses = callback,keep_collapses
+
+    def add_time(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage,0.)+seconds
+        self.calls[stage] = self.calls.get(stage,0)+1
+
+    def timed(self, stage: str, function, *args):
+        """
+        Call a function, adding its wall time to a stage
+        """
+        self.running.add(stage)
+        start = perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.add_time(stage,perf_counter()-start)
+            self.running.discard(stage)
+
+    def collapse(self, function, odict, dl: int, sigma: float, engine: str, previous=None):
+        """
+        Call collapse_states, timing it and recording its counts (passed to the callback, if any)
+        """
+        self.comparisons = 0
+        start = perf_counter()
+        refined = self.timed("collapse_states",function,odict,dl,sigma,engine,previous)
+        counts = {"lambda":dl,"sigma":sigma,"raw_states":len(odict),"refined_states":len(refined),
+                  "merges":len(odict)-len(refined),"pair_comparisons":self.comparisons,"warm":previous is not None,
+                  "seconds":perf_counter()-start}
+        for name in ("raw_states","refined_states","merges","pair_comparisons"):
+            self.totals[name] = self.totals.get(name,0)+counts[name]
+        self.totals["collapses"] = self.totals.get("collapses",0)+1
+        if(self.keep_collapses):
+            self.collapses.append(counts)
+        if(self.callback is not None):
+            self.callback(counts)
+        return refined
+
+    def report(self):
+        """
+        Summarise the record as a dictionary (ready for json)
+        """
+        return {"stages":{stage:{"seconds":self.seconds[stage],"calls":self.calls[stage]} for stage in self.seconds},
+                "totals":dict(self.totals),"collapses":list(self.collapses)}
+
+_instrumentation = None
+
+def start_instrumentation(callback=None, keep_collapses: bool = True):
+    """
+    Start recording stage times and collapse counts, returning the Instrumentation doing so
+    callback is called with the counts of each collapse as it finishes
+    """
+    global _instrumentation
+    _instrumentation = Instrumentation(callback,keep_collapses)
+    return _instrumentation
+
+def stop_instrumentation(path: str = None):
+    """
+    Stop recording, returning the report of everything recorded (or None if nothing was), also saved as JSON to path
+    """
+    global _instrumentation
+    report = _instrumentation.report() if _instrumentation is not None else None
+    _instrumentation = None
+    if(path is not None and report is not None):
+        import json
+        with open(path,"w") as f:
+            json.dump(report,f,indent=1)
+    return report
+
+class stage_timer:
+    """
+    Time a block of code as a stage (for use in a with statement), doing nothing unless instrumentation is started
+    """
+    __slots__ = ("stage","start")
+
+    def __init__(self, stage: str):
+        self.stage,self.start = stage,None
+
+    def __enter__(self):
+        if(_instrumentation is not None):
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if(self.start is not None and _instrumentation is not None):
+            _instrumentation.add_time(self.stage,perf_counter()-self.start)
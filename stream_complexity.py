@@ -0,0 +1,131 @@
+import argparse
+import socket
+import sys
+import time
+
+import numpy as np
+
+from main import *
+
+# Global variables
+COLUMNS = ['F7', 'Fp1', 'Fp2', 'F8', 'F3', 'Fz', 'F4', 'C3', 'Cz', 'P8', 'P7', 'Pz', 'P4', 'T3', 'P3', 'O1', 'O2', 'C4', 'T4']
+DL = 7  # Desired lambda
+SIGMA = 0.01  # Sigma value for state collapsing
+WINDOW_SIZE = 10  # Window size in seconds
+STEP_SIZE = 1  # Seconds between complexity values
+SAMPLE_RATE = 500  # Sample rate in Hz
+ENGINE = "suffix"  # State counting engine ("dict" walks the string, "numpy" integer codes, "suffix" suffix groups)
+
+
+class RingBuffer:
+    """
+    Hold the latest window of samples of every channel in a fixed array, overwriting the oldest.
+    """
+
+    def __init__(self, channels, capacity):
+        self.samples = np.zeros((channels, capacity))
+        self.capacity = capacity
+        self.position = 0  # where the next sample is written
+        self.count = 0  # samples written so far
+
+    def append(self, sample):
+        self.samples[:, self.position] = sample
+        self.position = (self.position + 1) % self.capacity
+        self.count += 1
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def window(self, channel):
+        """
+        The held samples of one channel, oldest first.
+        """
+        return np.concatenate((self.samples[channel, self.position:], self.samples[channel, :self.position]))
+
+
+def read_lines(source):
+    """
+    Yield each line of samples from a file object, skipping a header line if there is one.
+    """
+    for line in source:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield np.array(line.split(','), dtype=float)
+        except ValueError:
+            # the header (channel names) or a malformed line
+            continue
+
+
+def socket_lines(port):
+    """
+    Listen on a local port (a stand-in for the amplifier) and yield the lines sent by the first client.
+    """
+    with socket.create_server(("127.0.0.1", port)) as server:
+        print(f"Waiting for samples on 127.0.0.1:{port}", file=sys.stderr)
+        connection, address = server.accept()
+        with connection, connection.makefile("r") as source:
+            yield from read_lines(source)
+
+
+def stream_complexities(samples, budget):
+    """
+    Calculate the complexity of every channel's latest window each STEP_SIZE seconds of samples,
+    printing each row as it is found and the latency from the last sample of the step to the output.
+    """
+    window = WINDOW_SIZE * SAMPLE_RATE
+    step = STEP_SIZE * SAMPLE_RATE
+    ring = RingBuffer(len(COLUMNS), window)
+    latencies = []
+
+    print(",".join(["Time"] + COLUMNS + ["Latency_ms"]), flush=True)
+    for sample in samples:
+        arrived = time.perf_counter()
+        if len(sample) != len(COLUMNS):
+            print(f"Skipping sample with {len(sample)} values rather than {len(COLUMNS)}", file=sys.stderr)
+            continue
+        ring.append(sample)
+        if not ring.full() or (ring.count - window) % step != 0:
+            continue
+
+        complexities = []
+        for channel in range(len(COLUMNS)):
+            signal = ring.window(channel)
+            if np.isnan(signal).any():
+                complexities.append(np.nan)
+                continue
+            complexities.append(calculate(binarise(signal), DL, SIGMA, engine=ENGINE))
+
+        latency = (time.perf_counter() - arrived) * 1000
+        latencies.append(latency)
+        values = [f"{ring.count / SAMPLE_RATE:g}"] + [f"{complexity:.6f}" for complexity in complexities]
+        print(",".join(values + [f"{latency:.1f}"]), flush=True)
+        if latency > budget:
+            print(f"Latency {latency:.1f} ms over the {budget:g} ms budget", file=sys.stderr)
+
+    if latencies:
+        latencies = np.array(latencies)
+        print(f"{len(latencies)} steps, latency mean {latencies.mean():.1f} ms, "
+              f"95th percentile {np.percentile(latencies, 95):.1f} ms, max {latencies.max():.1f} ms, "
+              f"{(latencies > budget).sum()} over the {budget:g} ms budget", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate the complexity of live EEG samples, one line of "
+                                                 "comma-separated channel values per sample.")
+    parser.add_argument("--socket", type=int, metavar="PORT",
+                        help="Read samples from a local socket instead of stdin")
+    parser.add_argument("--budget", type=float, default=STEP_SIZE * 1000,
+                        help="Latency budget per step in milliseconds (default: one step)")
+    args = parser.parse_args()
+
+    samples = socket_lines(args.socket) if args.socket else read_lines(sys.stdin)
+    try:
+        stream_complexities(samples, args.budget)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()